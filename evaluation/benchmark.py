@@ -0,0 +1,237 @@
+# coding: utf-8
+
+# pylint: disable=missing-class-docstring
+
+"""
+Benchmark the retrieval stages and the self RAG graph offline
+
+RAGService.retrieve is run with the cases of evaluation/cases.py, configured by the same envs as the
+server, and the stages are measured by their spans (tools/metrics.span), against the docs of DOC_SOURCES
+in the vector table (BENCH_STORE=pgvector) or the markdown docs under BENCH_DOCS_DIR indexed into a scratch
+table (BENCH_STORE=docs). The query embeddings are not cached, so the embed stage measures the embed
+model in every round. The LLM is replaced by a deterministic fake LM, the result is written to
+BENCH_OUTPUT as JSON, so it can be compared across commits.
+"""
+
+import os
+import json
+import logging
+import math
+import threading
+import time
+from datetime import datetime, timezone
+import dspy
+from dotenv import load_dotenv
+from llama_index.core import Settings
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+from pydantic import BaseModel
+from services.index import RAGService
+from services.rerank import RerankService
+from tools.common import run_commands
+from tools.embeddings.cache import QueryEmbeddingCache
+from tools.embeddings.huggingface import BGE
+from tools.loaders.markdown import load_runbooks
+from tools.metrics import registry
+from workflows.self_rag.context import ContextBudget
+from workflows.self_rag.state import new_state
+from workflows.self_rag_graph import build_self_rag_graph
+from evaluation.cases import irrelevant_cases, cluster_cases, addon_cases, question_cases, negative_cases
+
+logger = logging.getLogger(__name__)
+
+SCRATCH_TABLE = "bench_vector_docs"
+BENCH_SOURCE = "benchmark"
+
+class StageStats(BaseModel):
+    stage: str
+    count: int
+    mean_ms: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+
+class Throughput(BaseModel):
+    phase: str
+    cases: int
+    seconds: float
+    cases_per_second: float
+
+class BenchmarkResult(BaseModel):
+    commit: str
+    create_at: datetime
+    store: str
+    cases: int
+    rounds: int
+    stages: list[StageStats]
+    throughput: list[Throughput]
+
+class StageTimer:
+    """
+    The samples of the stage spans, it is registered as an observer of the metrics registry.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples: dict[str, list[float]] = {}
+        self.enabled = True
+
+    def observe(self, stage: str, seconds: float):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.samples.setdefault(stage, []).append(seconds)
+
+    def record(self, stage: str, start_time: float):
+        self.observe(stage, time.perf_counter() - start_time)
+
+    def stats(self) -> list[StageStats]:
+        return [to_stats(stage, samples) for stage, samples in self.samples.items()]
+
+class FakeLM(dspy.LM):
+    """
+    A deterministic LM, it answers every output field of the signatures in the self RAG workflow with
+    a fixed value after a fixed latency.
+    """
+
+    def __init__(self, latency_ms=0):
+        super().__init__(model="fake/fake-lm", cache=False)
+        self.latency = latency_ms / 1000
+
+    def __call__(self, prompt=None, messages=None, **kwargs):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        # the adapter only parses the output fields of the signature, the others are ignored
+        return ["\n\n".join([
+            "[[ ## reasoning ## ]]\nThe relevant documents are used.",
+            "[[ ## new_query ## ]]\ntroubleshoot why the status of the cluster is unknown",
+            "[[ ## response ## ]]\nCheck the status of the klusterlet on the managed cluster.",
+            "[[ ## score ## ]]\n10",
+            "[[ ## completed ## ]]",
+        ])]
+
+def to_stats(stage: str, samples: list[float]) -> StageStats:
+    ordered = sorted(samples)
+    return StageStats(
+        stage=stage,
+        count=len(ordered),
+        mean_ms=sum(ordered) / len(ordered) * 1000,
+        p50_ms=percentile(ordered, 50) * 1000,
+        p95_ms=percentile(ordered, 95) * 1000,
+        p99_ms=percentile(ordered, 99) * 1000,
+    )
+
+def percentile(ordered: list[float], p: int) -> float:
+    # the nearest-rank percentile
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+def to_throughput(phase: str, cases: int, seconds: float) -> Throughput:
+    return Throughput(phase=phase, cases=cases, seconds=seconds, cases_per_second=cases / seconds)
+
+def rag_service(db_table: str, reranker: RerankService) -> RAGService:
+    # the same settings as the server, so the measured retrieval is the served one
+    return RAGService(
+        db_url=os.getenv("DATABASE_URL"),
+        embed_dim=BGE.dims,
+        db_table=db_table,
+        similarity_cutoff=float(os.getenv("SIMILARITY_CUTOFF", "0.5")),
+        top_k=int(os.getenv("RETRIEVE_TOP_K", "10")),
+        top_n=int(os.getenv("RERANK_TOP_N", "3")),
+        hnsw_ef_search=int(os.getenv("HNSW_EF_SEARCH", "300")),
+        reranker=reranker,
+        # no cached entries, the repeated cases would measure the cache lookup instead of the embed model
+        embed_cache=QueryEmbeddingCache(max_entries=0),
+        source_filter=os.getenv("SOURCE_FILTER", "post"),
+        hybrid_search=os.getenv("HYBRID_SEARCH", "false").lower() == "true",
+    )
+
+def docs_service(docs_dir: str, reranker: RerankService) -> RAGService:
+    rag_svc = rag_service(SCRATCH_TABLE, reranker)
+    rag_svc.delete_docs([BENCH_SOURCE], vacuum=False)
+    stats = rag_svc.index_docs(load_runbooks(md_dir=docs_dir, source=BENCH_SOURCE))
+    logger.info("scratch vector table (docs_dir=%s, nodes=%d) is ready", docs_dir, stats.nodes)
+    return rag_svc
+
+def head_commit() -> str:
+    result = run_commands(cmds=["git", "rev-parse", "HEAD"], cwd=None, timeout=10)
+    return result.stdout.strip() if result.return_code == 0 else "unknown"
+
+def run(store: str, rounds: int, lm_latency_ms: int) -> BenchmarkResult:
+    timer = StageTimer()
+    registry.add_observer(timer.observe)
+
+    reranker = RerankService(
+        max_batch_size=int(os.getenv("RERANK_MAX_BATCH_SIZE", "32")),
+        max_wait_ms=int(os.getenv("RERANK_MAX_WAIT_MS", "10")),
+    )
+    if store == "docs":
+        rag_svc = docs_service(os.getenv("BENCH_DOCS_DIR"), reranker)
+        sources = [BENCH_SOURCE]
+    else:
+        rag_svc = rag_service(os.getenv("BENCH_TABLE", "vector_docs"), reranker)
+        sources = os.getenv("DOC_SOURCES").split(",")
+
+    cases = irrelevant_cases + cluster_cases + addon_cases + question_cases + negative_cases
+    graph = build_self_rag_graph(rag_svc=rag_svc, budget=ContextBudget())
+
+    # warm up the models, so the loading time is not measured
+    rag_svc.retrieve(cases[0], sources)
+    timer.samples.clear()
+
+    throughput = []
+    phase_start_time = time.perf_counter()
+    for _ in range(rounds):
+        for case in cases:
+            start_time = time.perf_counter()
+            rag_svc.retrieve(case, sources)
+            timer.record("retrieve", start_time)
+    throughput.append(to_throughput("retrieve", rounds * len(cases), time.perf_counter() - phase_start_time))
+
+    # the retrieval stages are measured above, the graph adds its own stages, e.g. the answer
+    retrieve_samples = dict(timer.samples)
+    timer.samples.clear()
+    phase_start_time = time.perf_counter()
+    with dspy.context(lm=FakeLM(latency_ms=lm_latency_ms)):
+        for _ in range(rounds):
+            for case in cases:
+                start_time = time.perf_counter()
+                graph.invoke(new_state(doc_sources=sources, query=case, history_records=[]))
+                timer.record("graph", start_time)
+    throughput.append(to_throughput("graph", rounds * len(cases), time.perf_counter() - phase_start_time))
+    timer.enabled = False
+
+    stages = [to_stats(stage, samples) for stage, samples in retrieve_samples.items()]
+    stages.extend(to_stats(stage, samples) for stage, samples in timer.samples.items()
+                  if stage not in retrieve_samples)
+    return BenchmarkResult(
+        commit=head_commit(),
+        create_at=datetime.now(timezone.utc),
+        store=store,
+        cases=len(cases),
+        rounds=rounds,
+        stages=stages,
+        throughput=throughput,
+    )
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+
+    Settings.llm = None
+    Settings.embed_model = HuggingFaceEmbedding(model_name=BGE.name)
+    Settings.transformations = [SentenceSplitter(chunk_size=BGE.chunk_size, chunk_overlap=200)]
+
+    bench_result = run(
+        store=os.getenv("BENCH_STORE", "docs"),
+        rounds=int(os.getenv("BENCH_ROUNDS", "3")),
+        lm_latency_ms=int(os.getenv("BENCH_LM_LATENCY_MS", "0")),
+    )
+    output = os.getenv("BENCH_OUTPUT", "benchmark.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(bench_result.model_dump(mode="json"), f, indent=2)
+
+    for stats in bench_result.stages:
+        print(f"{stats.stage:<20} n={stats.count:<5} mean={stats.mean_ms:.1f}ms p50={stats.p50_ms:.1f}ms "
+              f"p95={stats.p95_ms:.1f}ms p99={stats.p99_ms:.1f}ms")
+    for phase in bench_result.throughput:
+        print(f"{phase.phase:<20} n={phase.cases:<5} {phase.cases_per_second:.2f} cases/s ({phase.seconds:.1f}s)")
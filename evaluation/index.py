@@ -13,7 +13,7 @@ from dotenv import load_dotenv
 from llama_index.core import Settings
 from llama_index.core.node_parser import SentenceSplitter
 from llama_index.embeddings.huggingface import HuggingFaceEmbedding
-from signatures.retriever import convert_question, grade_relevant_nodes
+from signatures.retriever import GradeCache, convert_question, grade_relevant_nodes
 from services.index import RAGService
 from services.storage import StorageService
 from tools.embeddings.huggingface import BGE
@@ -48,6 +48,10 @@ storage_svc = StorageService(db_url=os.getenv("DATABASE_URL"))
 rag_svc = RAGService(db_url=os.getenv("DATABASE_URL"), embed_dim=BGE.dims)
 sources=os.getenv("DOC_SOURCES").split(",")
 
+# grade settings
+grade_mode = os.getenv("GRADE_MODE", "parallel")
+grade_cache = GradeCache()
+
 def list_issues():
     issues = {}
     for issue in storage_svc.list_issue():
@@ -87,9 +91,9 @@ def retrieve(query, with_grade=False):
         return
 
     start_time = time.time()
-    relevant_nodes = grade_relevant_nodes(nodes, query)
+    relevant_nodes = grade_relevant_nodes(nodes, query, mode=grade_mode, cache=grade_cache)
     g_elapsed_time = time.time() - start_time
-    print(f"grade time used {g_elapsed_time:.3f}")
+    print(f"grade time used {g_elapsed_time:.3f} (mode={grade_mode})")
     print("relevant nodes:", len(relevant_nodes))
     for rn in relevant_nodes:
         print(f"{rn.score}, {rn.node.score:.3f}, {rn.node.metadata["filename"]}")
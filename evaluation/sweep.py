@@ -0,0 +1,236 @@
+# coding: utf-8
+
+# pylint: disable=missing-class-docstring
+
+"""
+Sweep the HNSW search and rerank settings for the recall and latency trade-offs
+
+The retrieval is run through RAGService against the vector table with its SOURCE_FILTER mode, the same
+source-filtered search as the server. The nodes of DOC_SOURCES are copied into a scratch table only
+for the ground truth, the exact (brute-force) neighbours of the cases of evaluation/cases.py. For the
+HNSW index of the vector table, the ef_search, top_k, similarity_cutoff and top_n are grided:
+  - ann_recall: the recall of the top_k nodes of the filtered search against the exact top_k nodes.
+  - recall: the recall of the retrieved top_n nodes against the reranked top_n nodes of the exact
+        SWEEP_TRUTH_K nodes.
+  - latency: the time of RAGService.retrieve, the query embeddings are cached before.
+The points and their Pareto frontier are written to SWEEP_OUTPUT as JSON, and the settings of the fastest
+point with the recall not less than SWEEP_TARGET_RECALL are written to SWEEP_ENV_OUTPUT as the envs of the
+server, e.g. HNSW_EF_SEARCH. The index build settings (HNSW_M, HNSW_EF_CONSTRUCTION) are the ones of the
+existing index, they are recorded rather than swept, since the served table is not rebuilt.
+"""
+
+import os
+import itertools
+import json
+import logging
+import time
+import numpy as np
+from dotenv import load_dotenv
+from llama_index.core import Settings
+from llama_index.core.schema import NodeWithScore
+from llama_index.core.vector_stores.utils import metadata_dict_to_node
+from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+from pydantic import BaseModel
+from sqlalchemy import Engine, create_engine, text
+from services.index import RAGService
+from services.rerank import RerankService
+from tools.embeddings.cache import QueryEmbeddingCache
+from tools.embeddings.huggingface import BGE
+from evaluation.benchmark import head_commit, percentile
+from evaluation.cases import cluster_cases, addon_cases, question_cases, negative_cases
+
+logger = logging.getLogger(__name__)
+
+SCRATCH_TABLE = "sweep_vector_docs"
+
+class SweepPoint(BaseModel):
+    hnsw_m: int
+    hnsw_ef_construction: int
+    hnsw_ef_search: int
+    top_k: int
+    similarity_cutoff: float
+    top_n: int
+    ann_recall: float
+    recall: float
+    p50_ms: float
+    p95_ms: float
+
+class SweepResult(BaseModel):
+    commit: str
+    source_filter: str
+    cases: int
+    nodes: int
+    points: list[SweepPoint]
+    frontier: list[SweepPoint]
+
+class Case:
+    def __init__(self, query: str, embedding: list[float]):
+        self.query = query
+        self.embedding = embedding
+        self.exact_ids: list[str] = []
+        self.truth_ids: dict[int, set[str]] = {}
+
+def sweep_grid(name: str, default: str, convert=int) -> list:
+    return [convert(value) for value in os.getenv(name, default).split(",")]
+
+def copy_nodes(engine: Engine, table: str, sources: list[str]) -> int:
+    with engine.begin() as conn:
+        conn.execute(text(f"DROP TABLE IF EXISTS {SCRATCH_TABLE}"))
+        conn.execute(text(f"CREATE TABLE {SCRATCH_TABLE} AS SELECT node_id, text, metadata_, embedding "
+                          f"FROM {table} WHERE metadata_->>'source' = ANY(:sources)"), {"sources": sources})
+        return conn.execute(text(f"SELECT count(*) FROM {SCRATCH_TABLE}")).scalar()
+
+def exact_search(engine: Engine, cases: list[Case], k: int):
+    # brute-force cosine similarities over all of the nodes of the sources
+    with engine.connect() as conn:
+        rows = conn.execute(text(f"SELECT node_id, embedding::text FROM {SCRATCH_TABLE}")).all()
+    node_ids = [row[0] for row in rows]
+    matrix = np.array([json.loads(row[1]) for row in rows], dtype=np.float32)
+    matrix = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+    for case in cases:
+        query = np.array(case.embedding, dtype=np.float32)
+        similarities = matrix @ (query / np.linalg.norm(query))
+        case.exact_ids = [node_ids[i] for i in np.argsort(-similarities)[:k]]
+
+def exact_rows(engine: Engine, case: Case, k: int) -> list[tuple[str, str, dict, float]]:
+    # the exact neighbours are loaded by their ids, so the HNSW index is not involved
+    with engine.connect() as conn:
+        rows = conn.execute(text(f"SELECT node_id, text, metadata_, 1 - (embedding <=> CAST(:q AS vector)) "
+                                 f"FROM {SCRATCH_TABLE} WHERE node_id = ANY(:ids)"),
+                            {"q": str(case.embedding), "ids": case.exact_ids[:k]}).all()
+    return sorted([tuple(row) for row in rows], key=lambda row: -row[3])
+
+def rerank(reranker: RerankService, query: str, rows: list[tuple[str, str, dict, float]]) -> list[str]:
+    # the nodes are reranked with the same content as RAGService
+    nodes = []
+    for node_id, node_text, metadata, score in rows:
+        node = metadata_dict_to_node(metadata, text=node_text)
+        node.id_ = node_id
+        nodes.append(NodeWithScore(node=node, score=score))
+    reranked = reranker.rerank(nodes, query=query, top_n=len(nodes))
+    return [node.node_id for node in reranked if node.score > 0]
+
+def pareto_frontier(points: list[SweepPoint]) -> list[SweepPoint]:
+    frontier = []
+    for point in sorted(points, key=lambda p: (p.p50_ms, -p.recall)):
+        if len(frontier) == 0 or point.recall > frontier[-1].recall:
+            frontier.append(point)
+    return frontier
+
+def to_envs(point: SweepPoint) -> str:
+    return "\n".join([
+        f"HNSW_EF_SEARCH={point.hnsw_ef_search}",
+        f"RETRIEVE_TOP_K={point.top_k}",
+        f"SIMILARITY_CUTOFF={point.similarity_cutoff}",
+        f"RERANK_TOP_N={point.top_n}",
+    ]) + "\n"
+
+def run(engine: Engine, rag_svc: RAGService, cases: list[Case], sources: list[str], truth_k: int,
+        hnsw_m: int, hnsw_ef_construction: int) -> list[SweepPoint]:
+    top_ks = sweep_grid("SWEEP_TOP_K", "5,10,20")
+    top_ns = sweep_grid("SWEEP_TOP_N", "3,5")
+    cutoffs = sweep_grid("SWEEP_SIMILARITY_CUTOFF", "0.3,0.5", float)
+
+    # the ground truth of the rerank, the reranked exact nodes
+    exact_search(engine, cases, max(truth_k, *top_ks))
+    for case in cases:
+        reranked_ids = rerank(rag_svc.reranker, case.query, exact_rows(engine, case, truth_k))
+        for top_n in top_ns:
+            case.truth_ids[top_n] = set(reranked_ids[:top_n])
+
+    points = []
+    for ef_search, top_k, cutoff, top_n in itertools.product(sweep_grid("SWEEP_HNSW_EF_SEARCH", "40,64,100,200,300"),
+                                                             top_ks, cutoffs, top_ns):
+        if ef_search < top_k:
+            continue
+
+        rag_svc.hnsw_ef_search = ef_search
+        rag_svc.similarity_top_k = top_k
+        rag_svc.similarity_cutoff = cutoff
+        rag_svc.rerank_top_n = top_n
+
+        ann_recalls = []
+        recalls = []
+        latencies = []
+        for case in cases:
+            nodes = rag_svc.search(case.query, case.embedding, sources)
+            ann_recalls.append(len({node.node_id for node in nodes} & set(case.exact_ids[:top_k])) / top_k)
+
+            start_time = time.perf_counter()
+            nodes = rag_svc.retrieve(case.query, sources)
+            latencies.append(time.perf_counter() - start_time)
+
+            truth_ids = case.truth_ids[top_n]
+            if len(truth_ids) > 0:
+                recalls.append(len({node.node_id for node in nodes} & truth_ids) / len(truth_ids))
+
+        latencies.sort()
+        point = SweepPoint(
+            hnsw_m=hnsw_m,
+            hnsw_ef_construction=hnsw_ef_construction,
+            hnsw_ef_search=ef_search,
+            top_k=top_k,
+            similarity_cutoff=cutoff,
+            top_n=top_n,
+            ann_recall=sum(ann_recalls) / len(ann_recalls),
+            recall=sum(recalls) / len(recalls) if len(recalls) > 0 else 1.0,
+            p50_ms=percentile(latencies, 50) * 1000,
+            p95_ms=percentile(latencies, 95) * 1000,
+        )
+        logger.info("%s", point)
+        points.append(point)
+    return points
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+
+    Settings.embed_model = HuggingFaceEmbedding(model_name=BGE.name)
+
+    doc_sources = os.getenv("DOC_SOURCES").split(",")
+    index_hnsw_m = int(os.getenv("HNSW_M", "16"))
+    index_hnsw_ef_construction = int(os.getenv("HNSW_EF_CONSTRUCTION", "64"))
+    sweep_rag_svc = RAGService(
+        db_url=os.getenv("DATABASE_URL"),
+        embed_dim=BGE.dims,
+        db_table=os.getenv("SWEEP_TABLE", "vector_docs"),
+        hnsw_m=index_hnsw_m,
+        hnsw_ef_construction=index_hnsw_ef_construction,
+        embed_cache=QueryEmbeddingCache(),
+        source_filter=os.getenv("SOURCE_FILTER", "post"),
+        hybrid_search=os.getenv("HYBRID_SEARCH", "false").lower() == "true",
+    )
+
+    db_engine = create_engine(os.getenv("DATABASE_URL"))
+    sweep_rag_svc.vector_store._initialize()
+    vector_table = f"{sweep_rag_svc.vector_store.schema_name}.{sweep_rag_svc.vector_store._table_class.__tablename__}"
+    total_nodes = copy_nodes(db_engine, table=vector_table, sources=doc_sources)
+    # the query embeddings are cached, so the latencies are of the search and the rerank
+    sweep_cases = [Case(query, sweep_rag_svc.embed_cache.get_query_embedding(query))
+                   for query in cluster_cases + addon_cases + question_cases + negative_cases]
+    try:
+        sweep_points = run(db_engine, sweep_rag_svc, sweep_cases, doc_sources, int(os.getenv("SWEEP_TRUTH_K", "20")),
+                           index_hnsw_m, index_hnsw_ef_construction)
+    finally:
+        with db_engine.begin() as db_conn:
+            db_conn.execute(text(f"DROP TABLE IF EXISTS {SCRATCH_TABLE}"))
+
+    sweep_result = SweepResult(commit=head_commit(), source_filter=sweep_rag_svc.source_filter,
+                               cases=len(sweep_cases), nodes=total_nodes,
+                               points=sweep_points, frontier=pareto_frontier(sweep_points))
+    with open(os.getenv("SWEEP_OUTPUT", "sweep.json"), "w", encoding="utf-8") as f:
+        json.dump(sweep_result.model_dump(mode="json"), f, indent=2)
+
+    for frontier_point in sweep_result.frontier:
+        print(f"recall={frontier_point.recall:.3f} ann_recall={frontier_point.ann_recall:.3f} "
+              f"p50={frontier_point.p50_ms:.1f}ms p95={frontier_point.p95_ms:.1f}ms "
+              f"(ef_search={frontier_point.hnsw_ef_search}, top_k={frontier_point.top_k}, "
+              f"cutoff={frontier_point.similarity_cutoff}, top_n={frontier_point.top_n})")
+
+    target_recall = float(os.getenv("SWEEP_TARGET_RECALL", "0.95"))
+    chosen = [point for point in sweep_result.frontier if point.recall >= target_recall]
+    if len(chosen) > 0:
+        env_output = os.getenv("SWEEP_ENV_OUTPUT", "sweep.env")
+        with open(env_output, "w", encoding="utf-8") as f:
+            f.write(to_envs(chosen[0]))
+        print(f"the settings of recall {chosen[0].recall:.3f} are written to {env_output}")
@@ -24,3 +24,8 @@ curl -s -X PUT --header "Content-Type: application/json" \
     -d '{"issue_id": "'$issue_id'", "resp_id": "'$resp_id'", "score": 1}'
 
 # continue ...
+
+# stream the response of an issue with server-sent events
+curl -s -N -X POST --header "Content-Type: application/json" \
+    $api_host/chat/stream \
+    -d '{"query": "my cluster local-cluster is unknown"}'
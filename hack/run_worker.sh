@@ -0,0 +1,16 @@
+#!/usr/bin/env bash
+
+REPO_DIR="$(cd "$(dirname ${BASH_SOURCE[0]})/.." ; pwd -P)"
+
+output_dir=${REPO_DIR}/_output
+log_dir=${output_dir}/logs
+
+mkdir -p ${log_dir}
+
+date_suffix=$(date +"%Y%m%d%H%M%S")
+
+(exec python -m tasks.worker) &> ${log_dir}/worker.${date_suffix}.log &
+worker_pid=$!
+echo "$worker_pid" > ${output_dir}/"worker_pid.${date_suffix}"
+echo "worker ($worker_pid) is running ..."
+echo "${log_dir}/worker.${date_suffix}.log"
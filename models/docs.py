@@ -4,6 +4,7 @@
 The models of doc
 """
 
+from datetime import datetime
 from pydantic import BaseModel
 
 class RunBookSetVersion(BaseModel):
@@ -14,8 +15,24 @@ class RunBookSetRequest(BaseModel):
     repo: str
     branch: str = "main"
 
+class IndexProgress(BaseModel):
+    files_converted: int = 0
+    docs_read: int = 0
+    nodes_embedded: int = 0
+    nodes_written: int = 0
+    nodes_carried: int = 0
+
+class IndexJobStatus(BaseModel):
+    version: str
+    state: str
+    attempts: int
+    error: str | None = None
+    progress: IndexProgress | None = None
+    update_at: datetime
+
 class RunBookSetResponse(BaseModel):
     id: str
     repo: str
     branch: str
     versions: list[RunBookSetVersion] | None = None
+    job: IndexJobStatus | None = None
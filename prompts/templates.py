@@ -26,3 +26,10 @@ CONVERTOR_NOTICES = f"""
 - The query should be about ACM.
 - If the query is not related to ACM, return an empty string.
 """
+
+SUMMARY_NOTICES = f"""
+{COMMON_NOTICES}
+- Merge the history records into the summary, the summary should cover the whole conversation.
+- Keep the user's environment, the symptoms, the checked causes, the suggested actions and their results.
+- Keep the names of the clusters, addons and resources.
+- Drop the greetings and the repeated content."""
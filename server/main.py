@@ -4,27 +4,38 @@
 The server of ACM troubleshooter service
 """
 
+import asyncio
+import json
 import logging
 import os
 import shutil
 import uuid
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-from fastapi import BackgroundTasks, FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException
+from fastapi import Request as HTTPRequest
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse
+from fastapi.responses import PlainTextResponse, RedirectResponse, StreamingResponse
 from llama_index.core import Settings
 from llama_index.core.node_parser import SentenceSplitter
 from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 from models.contexts import LLMConfig, RetrievalConfig, Context
 from models.chat import Request, Response, EvaluationRequest
-from models.docs import RunBookSetRequest, RunBookSetResponse, RunBookSetVersion
+from models.docs import IndexJobStatus, RunBookSetRequest, RunBookSetResponse, RunBookSetVersion
+from services.answer_cache import AnswerCacheService
+from services.history import HistoryService
 from services.llm import LLMService
 from services.index import RAGService
-from services.storage import StorageService
-from tasks.runbooks import index
+from services.rerank import RerankService
+from services.storage import AsyncStorageService, ContextCache, StorageService
 from tools.common import is_empty
+from tools.executor import BoundedExecutor, ExecutorFullError
+from tools.lm import LMRegistry
+from tools.metrics import incr, registry, request_id, span
 from tools.git import parse_repo, clone, pull, fetch_head_commit
+from tools.embeddings.cache import QueryEmbeddingCache
 from tools.embeddings.huggingface import BGE
+from workflows.self_rag.context import ContextBudget
 
 # load envs
 load_dotenv()
@@ -39,7 +50,8 @@ logger = logging.getLogger(__name__)
 # rag settings
 Settings.llm = None
 Settings.context_window = 10240 # maximum input size to the LLM
-Settings.embed_model = HuggingFaceEmbedding(model_name=BGE.name)
+Settings.embed_model = HuggingFaceEmbedding(model_name=BGE.name,
+                                           embed_batch_size=int(os.getenv("EMBED_BATCH_SIZE", "32")))
 Settings.transformations = [SentenceSplitter(chunk_size=BGE.chunk_size, chunk_overlap=200)]
 # TODO use the latest doc sources
 doc_sources = os.getenv("DOC_SOURCES").split(",")
@@ -51,14 +63,99 @@ llm_api_key=os.getenv("LM_API_KEY")
 
 # init services
 storage_svc = StorageService(db_url=os.getenv("DATABASE_URL"))
-rag_svc = RAGService(db_url=os.getenv("DATABASE_URL"), embed_dim=BGE.dims)
-llm_svc = LLMService(rag_svc=rag_svc)
+async_storage_svc = AsyncStorageService(
+    db_url=os.getenv("DATABASE_URL"),
+    pool_size=int(os.getenv("DB_POOL_SIZE", "10")),
+    max_overflow=int(os.getenv("DB_POOL_MAX_OVERFLOW", "10")),
+    pool_pre_ping=os.getenv("DB_POOL_PRE_PING", "true").lower() == "true",
+    statement_cache_size=int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100")),
+)
+rerank_svc = RerankService(
+    max_batch_size=int(os.getenv("RERANK_MAX_BATCH_SIZE", "32")),
+    max_wait_ms=int(os.getenv("RERANK_MAX_WAIT_MS", "10")),
+)
+embed_cache = QueryEmbeddingCache(
+    max_entries=int(os.getenv("EMBED_CACHE_SIZE", "4096")),
+    path=os.getenv("EMBED_CACHE_PATH"),
+)
+rag_svc = RAGService(
+    db_url=os.getenv("DATABASE_URL"),
+    embed_dim=BGE.dims,
+    similarity_cutoff=float(os.getenv("SIMILARITY_CUTOFF", "0.5")),
+    top_k=int(os.getenv("RETRIEVE_TOP_K", "10")),
+    top_n=int(os.getenv("RERANK_TOP_N", "3")),
+    hnsw_m=int(os.getenv("HNSW_M", "16")),
+    hnsw_ef_construction=int(os.getenv("HNSW_EF_CONSTRUCTION", "64")),
+    hnsw_ef_search=int(os.getenv("HNSW_EF_SEARCH", "300")),
+    reranker=rerank_svc,
+    index_batch_size=int(os.getenv("INDEX_BATCH_SIZE", "256")),
+    index_queue_size=int(os.getenv("INDEX_QUEUE_SIZE", "4")),
+    embed_cache=embed_cache,
+    source_filter=os.getenv("SOURCE_FILTER", "post"),
+    hybrid_search=os.getenv("HYBRID_SEARCH", "false").lower() == "true",
+    lexical_top_n=int(os.getenv("LEXICAL_TOP_N", "3")),
+)
+lm_registry = LMRegistry(
+    idle_timeout=int(os.getenv("LM_IDLE_TIMEOUT", "600")),
+    max_entries=int(os.getenv("LM_MAX_CLIENTS", "32")),
+    max_history=int(os.getenv("LM_MAX_HISTORY", "16")),
+    max_connections=int(os.getenv("LM_MAX_CONNECTIONS", "64")),
+)
+chat_max_in_flight = int(os.getenv("CHAT_MAX_IN_FLIGHT", "4"))
+llm_svc = LLMService(
+    rag_svc=rag_svc,
+    lm_registry=lm_registry,
+    budget=ContextBudget(
+        max_tokens=int(os.getenv("CONTEXT_MAX_TOKENS", "8000")),
+        history_max_tokens=int(os.getenv("CONTEXT_HISTORY_MAX_TOKENS", "2000")),
+    ),
+    speculative_rewrite=os.getenv("SPECULATIVE_REWRITE", "false").lower() == "true",
+    # one speculative rewrite per in-flight chat
+    rewrite_workers=chat_max_in_flight,
+)
+answer_cache = AnswerCacheService(
+    storage_svc=storage_svc,
+    embed_cache=embed_cache,
+    similarity_threshold=float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95")),
+)
+history_svc = HistoryService(
+    storage_svc=storage_svc,
+    lm_registry=lm_registry,
+    max_turns=int(os.getenv("HISTORY_MAX_TURNS", "6")),
+    max_tokens=int(os.getenv("HISTORY_MAX_TOKENS", "2000")),
+    keep_turns=int(os.getenv("HISTORY_KEEP_TURNS", "2")),
+)
+
+# the chat pipeline is blocking (llm, embedding, rerank and db calls), run it off the event loop
+chat_contexts = ContextCache(max_entries=int(os.getenv("CHAT_CONTEXT_CACHE_SIZE", "1024")))
+chat_executor = BoundedExecutor(
+    max_workers=chat_max_in_flight,
+    max_queued=int(os.getenv("CHAT_MAX_QUEUED", "16")),
+    name="chat",
+)
 
 # load configurations
 cwd = os.getenv("DOC_DIR")
+index_job_max_attempts = int(os.getenv("INDEX_JOB_MAX_ATTEMPTS", "3"))
+
+# the gauges of the services in /metrics
+registry.register_collector("rerank", lambda: rerank_svc.metrics().model_dump())
+registry.register_collector("embedding_cache", lambda: embed_cache.metrics().model_dump())
+registry.register_collector("lm_clients", lambda: lm_registry.metrics().model_dump())
+registry.register_collector("retrieve", lambda: llm_svc.retrieve_counters.metrics().model_dump())
+registry.register_collector("chat", lambda: {"pending": chat_executor.pending})
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    await async_storage_svc.init()
+    yield
+    # keep the warm query embeddings for the next start
+    embed_cache.save()
+    await async_storage_svc.close()
+    lm_registry.close()
 
 # start api server
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=[
@@ -72,8 +169,139 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def trace_request(request: HTTPRequest, call_next):
+    # the spans of a request share the request id, it is returned to the client for the correlation
+    rid = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    token = request_id.set(rid)
+    try:
+        response = await call_next(request)
+    finally:
+        request_id.reset(token)
+    response.headers["X-Request-ID"] = rid
+    return response
+
 @app.post("/chat")
 async def chat(req: Request) -> Response:
+    try:
+        return await chat_executor.run(do_chat, req)
+    except ExecutorFullError as e:
+        incr("chat_rejected")
+        raise HTTPException(status_code=429, detail="too many chat requests, please try again later",
+                            headers={"Retry-After": "1"}) from e
+
+@app.post("/chat/stream")
+async def chat_stream(req: Request) -> StreamingResponse:
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue()
+
+    def emit(event: str, data):
+        loop.call_soon_threadsafe(events.put_nowait, (event, data))
+
+    def produce():
+        try:
+            do_chat_stream(req, emit)
+        except Exception as e: # pylint: disable=broad-exception-caught
+            logger.error("failed to stream the chat response, %s", e)
+            emit("error", e)
+        finally:
+            loop.call_soon_threadsafe(events.put_nowait, None)
+
+    try:
+        chat_executor.submit(produce)
+    except ExecutorFullError as e:
+        incr("chat_rejected")
+        raise HTTPException(status_code=429, detail="too many chat requests, please try again later",
+                            headers={"Retry-After": "1"}) from e
+
+    # the first event is the issue, or the error if the request is invalid
+    first_event = await events.get()
+    if first_event[0] == "error":
+        if isinstance(first_event[1], HTTPException):
+            raise first_event[1]
+        raise HTTPException(status_code=500, detail=str(first_event[1]))
+
+    async def send_events():
+        event = first_event
+        while event is not None:
+            name, data = event
+            if name == "error":
+                data = {"detail": data.detail if isinstance(data, HTTPException) else str(data)}
+            yield f"event: {name}\ndata: {json.dumps(data)}\n\n"
+            event = await events.get()
+
+    return StreamingResponse(send_events(), media_type="text/event-stream")
+
+def do_chat(req: Request) -> Response:
+    with span("chat"):
+        issue_id, mcfg, rcfg, history_resps = load_chat(req)
+
+        cached_resp = find_cached_answer(req, rcfg)
+        if cached_resp is not None:
+            return save_chat(issue_id, req.query, cached_resp)
+
+        history_summary, history_resps = history_svc.compact(issue_id, mcfg, history_resps)
+        llm_resp = llm_svc.response(mcfg=mcfg, rcfg=rcfg, query=req.query,
+                                    history_resps=history_resps, history_summary=history_summary)
+        resp = save_chat(issue_id, req.query, llm_resp)
+        cache_answer(req, rcfg, llm_resp, resp)
+        return resp
+
+def do_chat_stream(req: Request, emit):
+    with span("chat_stream"):
+        stream_chat(req, emit)
+
+def stream_chat(req: Request, emit):
+    issue_id, mcfg, rcfg, history_resps = load_chat(req)
+    emit("issue", {"issue_id": str(issue_id)})
+
+    cached_resp = find_cached_answer(req, rcfg)
+    if cached_resp is not None:
+        emit("stage", {"stage": "cached"})
+        emit("reasoning", cached_resp["reasoning"])
+        emit("response", cached_resp["response"])
+        emit("done", save_chat(issue_id, req.query, cached_resp).model_dump())
+        return
+
+    history_summary, history_resps = history_svc.compact(issue_id, mcfg, history_resps)
+    llm_resp = None
+    for event, data in llm_svc.stream_response(mcfg=mcfg, rcfg=rcfg, query=req.query,
+                                               history_resps=history_resps, history_summary=history_summary):
+        if event == "state":
+            llm_resp = data
+            continue
+        emit(event, data)
+
+    resp = save_chat(issue_id, req.query, llm_resp)
+    cache_answer(req, rcfg, llm_resp, resp)
+    emit("done", resp.model_dump())
+
+def find_cached_answer(req: Request, rcfg: RetrievalConfig):
+    # only the first-turn queries are answered from the cache
+    if not is_empty(req.issue_id):
+        return None
+
+    with span("answer_cache"):
+        resp = answer_cache.find(req.query, rcfg.doc_sources)
+    if resp is None:
+        return None
+
+    incr("answer_cache_hits")
+    return {"response": resp.asst_resp, "reasoning": resp.reasoning, "relevant_doc_names": resp.referenced_docs,
+            "cached_resp_id": resp.id}
+
+def cache_answer(req: Request, rcfg: RetrievalConfig, llm_resp, resp: Response):
+    # only cache the first-turn answers that are based on the docs
+    if not is_empty(req.issue_id) or len(llm_resp["relevant_doc_names"]) == 0:
+        return
+
+    answer_cache.add(uuid.UUID(resp.resp_id), req.query, rcfg.doc_sources)
+
+def load_chat(req: Request) -> tuple[uuid.UUID, LLMConfig, RetrievalConfig, list]:
+    with span("load"):
+        return do_load_chat(req)
+
+def do_load_chat(req: Request) -> tuple[uuid.UUID, LLMConfig, RetrievalConfig, list]:
     issue_id = req.issue_id
 
     if is_empty(issue_id): # a new issue, create it and give an init response
@@ -93,64 +321,81 @@ async def chat(req: Request) -> Response:
             llm_cfg=ctx.llm_config.model_dump_json(),
             retrieval_cfg=ctx.retrieval_config.model_dump_json(),
         )
-
-        llm_resp = llm_svc.response(mcfg=ctx.llm_config, rcfg=ctx.retrieval_config, query=req.query, history_resps=[])
-
-        db_resp = storage_svc.create_resp(
-            issue_id=issue.id,
-            user_query=req.query,
-            asst_resp=llm_resp["response"],
-            reasoning=llm_resp["reasoning"],
-            referenced_docs = llm_resp["relevant_doc_names"],
-        )
-        return Response(issue_id=str(db_resp.issue_id), resp_id=str(db_resp.id),
-                        resp=db_resp.asst_resp, reasoning=db_resp.reasoning)
+        chat_contexts.put(issue.id, ctx.llm_config, ctx.retrieval_config)
+        return issue.id, ctx.llm_config, ctx.retrieval_config, []
 
     # an existed issue, continue to resolve the issue with user's new inputs
     if is_empty(req.query):
         raise HTTPException(status_code=422, detail="the user inputs are required")
 
-    ctx = storage_svc.find_context(uuid.UUID(issue_id))
-    if ctx is None:
-        raise HTTPException(status_code=404, detail="the issue context not found")
-
-    issue = storage_svc.get_issue(uuid.UUID(issue_id))
-    if issue is None:
+    # the context is only loaded and parsed if it is not cached
+    cached_cfgs = chat_contexts.get(uuid.UUID(issue_id))
+    snapshot = storage_svc.load_issue_snapshot(uuid.UUID(issue_id), with_context=cached_cfgs is None)
+    if snapshot is None:
         raise HTTPException(status_code=404, detail="the issue not found")
 
-    llm_resp = llm_svc.response(
-        mcfg=LLMConfig.model_validate_json(ctx.llm_config),
-        rcfg=RetrievalConfig.model_validate_json(ctx.retrieval_config),
-        query=req.query,
-        history_resps=storage_svc.list_resp(uuid.UUID(issue_id)),
-    )
+    if cached_cfgs is None:
+        if snapshot.context is None:
+            raise HTTPException(status_code=404, detail="the issue context not found")
 
-    db_resp = storage_svc.create_resp(
-        issue_id=issue_id,
-        user_query=req.query,
-        asst_resp=llm_resp["response"],
-        reasoning=llm_resp["reasoning"],
-        referenced_docs = llm_resp["relevant_doc_names"],
-    )
+        cached_cfgs = (
+            LLMConfig.model_validate_json(snapshot.context.llm_config),
+            RetrievalConfig.model_validate_json(snapshot.context.retrieval_config),
+        )
+        chat_contexts.put(snapshot.issue.id, *cached_cfgs)
+
+    mcfg, rcfg = cached_cfgs
+    return snapshot.issue.id, mcfg, rcfg, snapshot.responses
+
+def save_chat(issue_id: uuid.UUID, query: str, llm_resp) -> Response:
+    with span("persist"):
+        db_resp = storage_svc.create_resp(
+            issue_id=issue_id,
+            user_query=query,
+            asst_resp=llm_resp["response"],
+            reasoning=llm_resp["reasoning"],
+            referenced_docs = llm_resp["relevant_doc_names"],
+            cached_resp_id=llm_resp.get("cached_resp_id"),
+        )
     return Response(issue_id=str(db_resp.issue_id), resp_id=str(db_resp.id),
                     resp=db_resp.asst_resp, reasoning=db_resp.reasoning)
 
 @app.put("/evaluation")
 async def evaluate(req: EvaluationRequest):
-    issue = storage_svc.get_issue(uuid.UUID(req.issue_id))
+    issue = await async_storage_svc.get_issue(uuid.UUID(req.issue_id))
     if issue is None:
         raise HTTPException(status_code=404, detail="the issue not found")
 
-    resp = storage_svc.get_resp(uuid.UUID(req.resp_id))
+    resp = await async_storage_svc.get_resp(uuid.UUID(req.resp_id))
     if resp is None:
         raise HTTPException(status_code=404, detail="the responses not found")
 
-    storage_svc.evaluate(issue.id, resp.id, req.score, req.feedback)
+    await async_storage_svc.evaluate(issue.id, resp.id, req.score, req.feedback)
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/metrics/rerank")
+async def rerank_metrics():
+    return rerank_svc.metrics()
+
+@app.get("/metrics/embedding")
+async def embedding_metrics():
+    return embed_cache.metrics()
+
+@app.get("/metrics/retrieve")
+async def retrieve_metrics():
+    return llm_svc.retrieve_counters.metrics()
+
+@app.get("/metrics/lm")
+async def lm_metrics():
+    return lm_registry.metrics()
 
 @app.get("/runbooksets")
 async def list_runbook_sets():
     rs_list = []
-    for rs in storage_svc.list_runbook_set():
+    for rs in await async_storage_svc.list_runbook_set():
         rs_list.append(
             RunBookSetResponse(id=str(rs.id), repo=rs.repo, branch=rs.branch)
         )
@@ -158,21 +403,34 @@ async def list_runbook_sets():
 
 @app.get("/runbooksets/{runbook_set_id}")
 async def get_runbook_set(runbook_set_id: str):
-    rs = storage_svc.get_runbook_set(uuid.UUID(runbook_set_id))
+    rs = await async_storage_svc.get_runbook_set(uuid.UUID(runbook_set_id))
     if rs is None:
         raise HTTPException(status_code=404, detail="the runbook set not found")
 
     versions = []
-    rsvs = storage_svc.list_runbook_set_versions(rs.id)
+    rsvs = await async_storage_svc.list_runbook_set_versions(rs.id)
     for rsv in rsvs:
         versions.append(RunBookSetVersion(version=rsv.version, state=rsv.state))
 
+    job_status = None
+    job = await async_storage_svc.find_latest_index_job(rs.id)
+    if job is not None:
+        job_status = IndexJobStatus(version=job.version, state=job.state, attempts=job.attempts, error=job.error,
+                                    progress=job.progress, update_at=job.update_at)
+
     return RunBookSetResponse(
-        id=str(rs.id), repo=rs.repo, branch=rs.branch, versions=versions
+        id=str(rs.id), repo=rs.repo, branch=rs.branch, versions=versions, job=job_status
     )
 
+def enqueue_index(runbook_set_id: uuid.UUID, repo_dir: str, version: str):
+    # the runbook set is indexed by the workers, see tasks/worker.py
+    job, created = storage_svc.enqueue_index_job(runbook_set_id=runbook_set_id, repo_dir=repo_dir, version=version,
+                                                 max_attempts=index_job_max_attempts)
+    if created:
+        logger.info("index job %s (%s) of runbook set %s is queued", str(job.id), version, str(runbook_set_id))
+
 @app.post("/runbooksets")
-async def create_or_update_runbook_set(req: RunBookSetRequest, bg_tasks: BackgroundTasks):
+def create_or_update_runbook_set(req: RunBookSetRequest):
     dist = f"{parse_repo(req.repo)}-{req.branch}"
     repo_dir = os.path.join(cwd, dist)
 
@@ -183,6 +441,10 @@ async def create_or_update_runbook_set(req: RunBookSetRequest, bg_tasks: Backgro
                 status_code=500, detail="the runbook set repo dir not found"
             )
 
+        # the repo is being read by a worker, it is not updated until the job is finished
+        if storage_svc.find_active_index_job(rs.id) is not None:
+            return RedirectResponse(status_code=303, url=f"/runbooksets/{str(rs.id)}")
+
         # update the repo
         pull_result = pull(cwd=repo_dir)
         if pull_result.return_code != 0:
@@ -195,11 +457,11 @@ async def create_or_update_runbook_set(req: RunBookSetRequest, bg_tasks: Backgro
 
         version = fetch_result.stdout
         rsv = storage_svc.find_runbook_set_version(version=version)
-        if rsv is not None:
-            # TODO if rsv status is failed, try to reindex
+        if rsv is not None and rsv.state == "indexed":
             return RedirectResponse(status_code=303, url=f"/runbooksets/{str(rs.id)}")
 
-        bg_tasks.add_task(index, rs.id, repo_dir, version, rag_svc, storage_svc)
+        # a new version, or a version that is failed or left over by an interrupted index, is (re)indexed
+        enqueue_index(rs.id, repo_dir, version)
         return RedirectResponse(status_code=303, url=f"/runbooksets/{str(rs.id)}")
 
     # clone the repo
@@ -216,21 +478,25 @@ async def create_or_update_runbook_set(req: RunBookSetRequest, bg_tasks: Backgro
 
     new_rs = storage_svc.create_runbook_set(repo=req.repo, branch=req.branch)
 
-    bg_tasks.add_task(index, new_rs.id, repo_dir, version, rag_svc, storage_svc)
+    enqueue_index(new_rs.id, repo_dir, version)
     return RedirectResponse(status_code=303, url=f"/runbooksets/{str(new_rs.id)}")
 
 @app.delete("/runbooksets/{runbook_set_id}")
-async def delete_runbook_sets(runbook_set_id: str):
+def delete_runbook_sets(runbook_set_id: str):
     rs = storage_svc.get_runbook_set(uuid.UUID(runbook_set_id))
     if rs is None:
         raise HTTPException(status_code=404, detail="the runbook set not found")
+    if storage_svc.find_active_index_job(rs.id) is not None:
+        raise HTTPException(status_code=409, detail="the runbook set is being indexed")
 
     dist = f"{parse_repo(rs.repo)}-{rs.branch}"
     repo_dir = os.path.join(cwd, dist)
     if os.path.exists(repo_dir):
         shutil.rmtree(repo_dir)
 
-    for rsv in storage_svc.list_runbook_set_versions(rs.id):
-        rag_svc.delete_docs(source=f"{dist}-{rsv.version}")
+    sources = [f"{dist}-{rsv.version}" for rsv in storage_svc.list_runbook_set_versions(rs.id)]
+    rag_svc.delete_docs(sources=sources)
+    for source in sources:
+        answer_cache.invalidate(source=source)
 
     storage_svc.delete_runbook_set(rs)
@@ -0,0 +1,51 @@
+# coding: utf-8
+
+# pylint: disable=missing-class-docstring
+
+"""
+The service to reuse the answers of the similar first-turn queries
+"""
+
+import logging
+import time
+import uuid
+from services.storage import Response, StorageService
+from tools.embeddings.cache import QueryEmbeddingCache
+
+logger = logging.getLogger(__name__)
+
+class AnswerCacheService:
+    """
+    A semantic cache over the answered first-turn queries, a query is answered by the nearest
+    answered query of the same doc sources if their similarity is not less than the similarity
+    threshold. The doc sources contain the doc versions, so the answers of the previous versions are
+    never matched, and the thumbs-down answers are excluded.
+    """
+
+    def __init__(self, storage_svc: StorageService, embed_cache: QueryEmbeddingCache, similarity_threshold=0.95):
+        self.storage_svc = storage_svc
+        self.embed_cache = embed_cache
+        self.similarity_threshold = similarity_threshold
+
+    def find(self, query: str, doc_sources: list[str]) -> Response:
+        start_time = time.time()
+        embedding = self.embed_cache.get_query_embedding(query)
+        resp, similarity = self.storage_svc.find_cached_answer(to_key(doc_sources), embedding)
+        if resp is None or similarity < self.similarity_threshold:
+            logger.info("no cached answer for %s, time used %.3fs", query, (time.time() - start_time))
+            return None
+
+        logger.info("cached answer (%s, similarity=%.3f) for %s, time used %.3fs",
+                    str(resp.id), similarity, query, (time.time() - start_time))
+        return resp
+
+    def add(self, resp_id: uuid.UUID, query: str, doc_sources: list[str]):
+        embedding = self.embed_cache.get_query_embedding(query)
+        self.storage_svc.add_cached_answer(resp_id=resp_id, doc_sources=to_key(doc_sources), query_embedding=embedding)
+
+    def invalidate(self, source: str):
+        deleted = self.storage_svc.delete_cached_answers(source)
+        logger.info("cached answers (source=%s, total=%d) were invalidated", source, deleted)
+
+def to_key(doc_sources: list[str]) -> str:
+    return ",".join(sorted(doc_sources))
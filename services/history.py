@@ -0,0 +1,69 @@
+# coding: utf-8
+
+# pylint: disable=missing-class-docstring
+
+"""
+The service to compact the issue histories
+"""
+
+import logging
+import time
+import uuid
+from models.contexts import LLMConfig
+from services.llm import to_records
+from services.storage import Response, StorageService
+from signatures.summary import summarize
+from tools.common import count_tokens
+from tools.lm import LMRegistry
+from tools.metrics import span
+
+logger = logging.getLogger(__name__)
+
+class HistoryService:
+    """
+    Compact the long issue histories with a rolling summary, once the turns that are not summarized yet
+    exceed max_turns or max_tokens, the older of them are merged into the summary of the issue, and
+    only the summary and the last keep_turns turns are sent to the LLM.
+      - max_turns: the maximum number of the turns that are sent verbatim.
+      - max_tokens: the maximum tokens of the turns that are sent verbatim.
+      - keep_turns: the number of the most recent turns that are kept verbatim after a compaction.
+    """
+
+    def __init__(self, storage_svc: StorageService, lm_registry: LMRegistry, max_turns=6, max_tokens=2000,
+                 keep_turns=2):
+        self.storage_svc = storage_svc
+        self.lm_registry = lm_registry
+        self.max_turns = max_turns
+        self.max_tokens = max_tokens
+        self.keep_turns = keep_turns
+
+    def compact(self, issue_id: uuid.UUID, mcfg: LLMConfig,
+                history_resps: list[Response]) -> tuple[str, list[Response]]:
+        """
+        Return the summary of the issue and the history responses that are not summarized.
+        """
+        history_resps = list(history_resps)
+        if len(history_resps) == 0:
+            return "", []
+
+        issue_summary = self.storage_svc.find_issue_summary(issue_id)
+        summary = issue_summary.summary if issue_summary is not None else ""
+        summarized_turns = issue_summary.turns if issue_summary is not None else 0
+
+        # the responses are ordered by the creation time, so the summarized turns are always the first ones
+        recent_resps = history_resps[summarized_turns:]
+        tokens = sum(count_tokens(record.message, model=mcfg.model) for record in to_records(recent_resps))
+        if len(recent_resps) <= self.max_turns and tokens <= self.max_tokens:
+            return summary, recent_resps
+
+        start_time = time.time()
+        split = max(len(recent_resps) - self.keep_turns, 1)
+        summarized_resps, recent_resps = recent_resps[:split], recent_resps[split:]
+        with self.lm_registry.context(mcfg), span("summarize"):
+            summary = summarize(summary=summary, history_records=to_records(summarized_resps))
+
+        self.storage_svc.save_issue_summary(issue_id, summary, summarized_turns + len(summarized_resps))
+        logger.info("issue %s history (turns=%d, tokens=%d) is compacted, summarized=%d, time used %.3fs",
+                    str(issue_id), len(summarized_resps) + len(recent_resps), tokens,
+                    summarized_turns + len(summarized_resps), (time.time() - start_time))
+        return summary, recent_resps
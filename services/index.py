@@ -1,6 +1,6 @@
 # coding: utf-8
 
-# pylint: disable=missing-class-docstring
+# pylint: disable=missing-class-docstring,protected-access
 
 """
 The service to index the docs
@@ -8,16 +8,28 @@ The service to index the docs
 
 import logging
 import time
-from llama_index.core import VectorStoreIndex
-from llama_index.core.postprocessor import SimilarityPostprocessor
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from typing import Callable, Iterable, Iterator
+from llama_index.core import Settings, VectorStoreIndex
+from llama_index.core.ingestion import run_transformations
 from llama_index.core.query_engine import RetrieverQueryEngine
-from llama_index.core.schema import Document, NodeWithScore
-from llama_index.core.vector_stores.types import MetadataFilter, MetadataFilters
+from llama_index.core.schema import (
+    BaseNode, Document, MetadataMode, NodeRelationship, NodeWithScore, ObjectType, QueryBundle, RelatedNodeInfo,
+)
+from llama_index.core.vector_stores.types import (
+    MetadataFilter, MetadataFilters, VectorStoreQuery, VectorStoreQueryMode,
+)
+from llama_index.core.vector_stores.utils import node_to_metadata_dict
 from llama_index.vector_stores.postgres import PGVectorStore
-from llama_index.postprocessor.flag_embedding_reranker import FlagEmbeddingReranker
 from pydantic import BaseModel
-from sqlalchemy import make_url
+from sqlalchemy import delete, event, insert, make_url, select, text
+from services.rerank import RerankService
 from tools.common import is_empty
+from tools.embeddings.cache import QueryEmbeddingCache
+from tools.metrics import incr, span
+from tools.pipeline import batched, stage
 
 logger = logging.getLogger(__name__)
 
@@ -26,9 +38,27 @@ class DocInfo(BaseModel):
     name: str
     hash: str
 
+class IndexStats(BaseModel):
+    docs: int = 0
+    nodes: int = 0
+    carried_docs: int = 0
+    carried_nodes: int = 0
+    elapsed: float = 0.0
+    nodes_per_sec: float = 0.0
+
+class DeleteStats(BaseModel):
+    rows: int = 0
+    elapsed: float = 0.0
+
+def no_progress(name: str, n: int): # pylint: disable=unused-argument
+    pass
+
 class RAGService:
     def __init__(self, db_url: str, embed_dim: int, db_table="vector_docs",
-                 similarity_cutoff=0.5, top_k=10, top_n=3, hnsw_ef_search=300):
+                 similarity_cutoff=0.5, top_k=10, top_n=3, hnsw_m=16, hnsw_ef_construction=64, hnsw_ef_search=300,
+                 reranker: RerankService=None,
+                 index_batch_size=256, index_queue_size=4, embed_cache: QueryEmbeddingCache=None, source_filter="post",
+                 hybrid_search=False, text_search_config="english", rrf_k=60, lexical_top_n=3):
         url = make_url(db_url)
         self.vector_store = PGVectorStore.from_params(
             database=url.database,
@@ -38,6 +68,8 @@ class RAGService:
             password=url.password,
             table_name=db_table,
             embed_dim=embed_dim,
+            hybrid_search=hybrid_search,
+            text_search_config=text_search_config,
             # HNSW (Hierarchical Navigable Small World)
             #  - hnsw_m: This parameter refers to the maximum number of bidirectional links created for
             #       every new element during the construction of the graph.
@@ -49,9 +81,11 @@ class RAGService:
             #       larger efSearch value results in more accurate search results at the cost of increased
             #       search time. This value should be equal or larger than k (the number of nearest neighbors
             #       you want to return)
+            # the index is only created with a new table, so hnsw_m and hnsw_ef_construction do not change
+            # the index of an existing table, evaluation/sweep.py measures their trade-offs.
             hnsw_kwargs={
-                "hnsw_m": 16, 
-                "hnsw_ef_construction": 64,
+                "hnsw_m": hnsw_m,
+                "hnsw_ef_construction": hnsw_ef_construction,
                 "hnsw_ef_search": 64,
                 "hnsw_dist_method": "vector_cosine_ops",
             },
@@ -61,45 +95,319 @@ class RAGService:
         self.similarity_top_k = top_k
         self.rerank_top_n = top_n
         self.hnsw_ef_search = hnsw_ef_search
+        self._reranker = reranker
+        self.index_batch_size = index_batch_size
+        self.index_queue_size = index_queue_size
+        self.embed_cache = embed_cache if embed_cache is not None else QueryEmbeddingCache()
+        self.source_filter = source_filter
+        self.setup_source_filter()
+        self.hybrid_search = hybrid_search
+        self.rrf_k = rrf_k
+        self.lexical_top_n = lexical_top_n
+        if hybrid_search:
+            self.setup_hybrid_search()
+            self._executor = ThreadPoolExecutor(thread_name_prefix="lexical-search")
+
+    @property
+    def reranker(self) -> RerankService:
+        # the reranker is loaded on first use, so the indexing workers never load it
+        if self._reranker is None:
+            self._reranker = RerankService()
+        return self._reranker
+
+    def setup_hybrid_search(self):
+        """
+        Set up the full-text search column and its GIN index for the lexical search, the vector store
+        only creates them with a new table, so they are added to an existing table here.
+        """
+        self.vector_store._initialize()
+        table = self.vector_store._table_class
+        table_name = f"{self.vector_store.schema_name}.{table.__tablename__}"
+        with self.vector_store._engine.begin() as conn:
+            text_search_config = self.vector_store.text_search_config
+            conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS text_search_tsv tsvector "
+                              f"GENERATED ALWAYS AS (to_tsvector('{text_search_config}', text)) STORED"))
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS {self.vector_store.table_name}_idx "
+                              f"ON {table_name} USING gin (text_search_tsv)"))
+
+    def setup_source_filter(self):
+        """
+        Set up how the ANN search is filtered by the doc sources:
+          - post: the HNSW candidates are filtered by the sources after the index scan, most of the
+                candidates are discarded once the table holds many sources.
+          - index: an expression index on the node source, so that the planner can select the rows of
+                the sources first and search them exactly when the sources are selective.
+          - iterative: the HNSW index scan continues until enough candidates pass the source filter,
+                this requires pgvector 0.8.0 or later.
+        """
+        if self.source_filter not in ("post", "index", "iterative"):
+            raise ValueError(f"unsupported source filter {self.source_filter}")
+
+        if self.source_filter == "post":
+            return
+
+        self.vector_store._initialize()
+        table = self.vector_store._table_class
+        engine = self.vector_store._engine
+
+        if self.source_filter == "index":
+            with engine.begin() as conn:
+                conn.execute(text(f"CREATE INDEX IF NOT EXISTS {table.__tablename__}_source_idx "
+                                  f"ON {self.vector_store.schema_name}.{table.__tablename__} "
+                                  "((metadata_->>'source'))"))
+                conn.execute(text(f"ANALYZE {self.vector_store.schema_name}.{table.__tablename__}"))
+            return
+
+        def set_iterative_scan(dbapi_conn, _):
+            # set it out of a transaction, otherwise it is rolled back when the connection is returned
+            autocommit = dbapi_conn.autocommit
+            dbapi_conn.autocommit = True
+            cursor = dbapi_conn.cursor()
+            cursor.execute("SET hnsw.iterative_scan = relaxed_order")
+            cursor.close()
+            dbapi_conn.autocommit = autocommit
+
+        # the pooled connections are created without the setting, drop them
+        event.listen(engine, "connect", set_iterative_scan)
+        engine.dispose()
 
-    def index_docs(self, docs: list[Document]):
-        if len(docs) == 0:
+    def index_docs(self, docs: Iterable[Document], batch_size: int=None,
+                   on_progress: Callable[[str, int], None]=None) -> IndexStats:
+        """
+        Index the docs in a streaming pipeline, see stream_index.
+        """
+        stats = self.stream_index(docs, batch_size=batch_size, on_progress=on_progress)
+        if stats.docs == 0:
             raise ValueError("there is no product docs or runbooks")
+        return stats
+
+    def stream_index(self, docs: Iterable[Document], batch_size: int=None,
+                     on_progress: Callable[[str, int], None]=None) -> IndexStats:
+        """
+        Index the docs in a streaming pipeline, the docs are read, split into nodes and embedded by the
+        stages on their own threads, and the nodes are written to the vector store in fixed-size batches,
+        one multi-row insert per batch. The stages are connected by bounded queues, so the embedding
+        overlaps with the file I/O, and the memory is bounded by the queue sizes rather than the docs.
+          - on_progress: it is called with ("nodes_embedded", n) and ("nodes_written", n) as the batches
+                are embedded and written, from the stage threads.
+        """
+        if batch_size is None:
+            batch_size = self.index_batch_size
+        if on_progress is None:
+            on_progress = no_progress
+
+        start_time = time.time()
+        stats = IndexStats()
+
+        def split(doc: Document) -> list[BaseNode]:
+            stats.docs = stats.docs + 1
+            return run_transformations([doc], Settings.transformations)
+
+        def embed(nodes: list[BaseNode]) -> list[BaseNode]:
+            with span("index_embed"):
+                self.embed_nodes(nodes)
+            on_progress("nodes_embedded", len(nodes))
+            return nodes
+
+        # read -> split -> embed -> write
+        docs = stage(docs, maxsize=self.index_queue_size, name="index-read")
+        split_nodes = stage(docs, split, maxsize=self.index_queue_size, name="index-split")
+        batches = stage(batched(chain.from_iterable(split_nodes), batch_size), embed,
+                        maxsize=self.index_queue_size, name="index-embed")
+        for batch in batches:
+            batch_start_time = time.time()
+            with span("index_write"):
+                self.write_nodes(batch)
+            on_progress("nodes_written", len(batch))
+            logger.debug("nodes (%d-%d) are indexed, write time used %.3fs",
+                         stats.nodes, stats.nodes + len(batch), (time.time() - batch_start_time))
+            stats.nodes = stats.nodes + len(batch)
+
+        stats.elapsed = time.time() - start_time
+        stats.nodes_per_sec = (stats.nodes / stats.elapsed) if stats.elapsed > 0 else 0.0
+        logger.info("docs (total=%d, nodes=%d) are indexed, time used %.3fs (%.1f nodes/sec)",
+                    stats.docs, stats.nodes, stats.elapsed, stats.nodes_per_sec)
+        return stats
+
+    def reindex_docs(self, docs: Iterable[Document], prev_source: str, batch_size: int=None,
+                     on_progress: Callable[[str, int], None]=None, source: str=None,
+                     changed_files: set[str]=None) -> IndexStats:
+        """
+        Index the docs of a new version incrementally against the previous indexed version, the docs are
+        compared by their (filename, hash), only the added or changed docs are embedded, the nodes of the
+        unchanged docs are carried forward with their embeddings, and the removed docs are dropped.
+          - changed_files: if it is set, the docs are only read from the changed files (the added, modified,
+                deleted and renamed files, e.g. by git diff), and the docs of the previous version in the
+                other files are carried forward into source without being read.
+        """
+        if changed_files is not None and source is None:
+            raise ValueError("the source is required for the changed files")
+        if batch_size is None:
+            batch_size = self.index_batch_size
+        if on_progress is None:
+            on_progress = no_progress
 
         start_time = time.time()
-        for doc in docs:
-            self.index.insert(doc)
-        logger.debug("docs (total=%d) are indexed, time used %.3fs", len(docs), (time.time() - start_time))
+        prev_docs: dict[tuple[str, str], DocInfo] = {}
+        for doc_info in self.list_docs(prev_source):
+            prev_docs.setdefault((doc_info.name, doc_info.hash), doc_info)
+
+        # the docs of previous version -> the unchanged docs of the new version, only their references are
+        # kept, so the unchanged docs are not held in memory
+        carried_docs: dict[str, RelatedNodeInfo] = {}
+        stats = IndexStats()
+
+        def changed_docs() -> Iterator[Document]:
+            for doc in docs:
+                stats.docs = stats.docs + 1
+                doc_info = prev_docs.pop((doc.metadata["filename"], doc.metadata["hash"]), None)
+                if doc_info is None:
+                    yield doc
+                    continue
+                carried_docs[doc_info.id] = doc.as_related_node_info()
 
-    def delete_docs(self, source: str):
-        doc_infos = self.list_docs(source)
-        for doc_info in doc_infos:
+        changed_stats = self.stream_index(changed_docs(), batch_size=batch_size, on_progress=on_progress)
+        if changed_files is not None:
+            for key, doc_info in list(prev_docs.items()):
+                if doc_info.name in changed_files:
+                    continue
+                # the doc is unchanged, so its metadata is rebuilt for the new version rather than read
+                carried_docs[doc_info.id] = RelatedNodeInfo(
+                    node_id=str(uuid.uuid4()),
+                    node_type=ObjectType.DOCUMENT,
+                    metadata={"filename": doc_info.name, "hash": doc_info.hash, "source": source},
+                )
+                stats.docs = stats.docs + 1
+                del prev_docs[key]
+        if stats.docs == 0:
+            raise ValueError("there is no product docs or runbooks")
+        logger.info("docs (total=%d) compared with %s, changed=%d, unchanged=%d, removed=%d",
+                    stats.docs, prev_source, changed_stats.docs, len(carried_docs), len(prev_docs))
+        stats.nodes = changed_stats.nodes
+        stats.carried_docs = len(carried_docs)
+
+        prev_ids = list(carried_docs.keys())
+        for i in range(0, len(prev_ids), batch_size):
+            nodes = self.vector_store.get_nodes(filters=MetadataFilters(
+                filters=[
+                    MetadataFilter(key="source", value=prev_source),
+                    MetadataFilter(key="ref_doc_id", value=prev_ids[i:i + batch_size], operator="in"),
+                ],
+                condition="and",
+            ))
+            self.write_nodes(self.carry_nodes(nodes, carried_docs))
+            stats.carried_nodes = stats.carried_nodes + len(nodes)
+            on_progress("nodes_carried", len(nodes))
+
+        stats.elapsed = time.time() - start_time
+        stats.nodes_per_sec = ((stats.nodes + stats.carried_nodes) / stats.elapsed) if stats.elapsed > 0 else 0.0
+        logger.info("docs (total=%d, nodes=%d, carried_nodes=%d) are reindexed, time used %.3fs",
+                    stats.docs, stats.nodes, stats.carried_nodes, stats.elapsed)
+        return stats
+
+    def carry_nodes(self, nodes: list[BaseNode], docs: dict[str, RelatedNodeInfo]) -> list[BaseNode]:
+        # the carried nodes get new ids, so that they are independent of the previous version
+        node_ids = {node.node_id: str(uuid.uuid4()) for node in nodes}
+        for node in nodes:
+            doc = docs[node.ref_doc_id]
+            node.id_ = node_ids[node.node_id]
+            node.metadata["source"] = doc.metadata["source"]
+            for relationship in (NodeRelationship.PREVIOUS, NodeRelationship.NEXT):
+                related_node = node.relationships.get(relationship)
+                if related_node is not None and related_node.node_id in node_ids:
+                    related_node.node_id = node_ids[related_node.node_id]
+            node.relationships[NodeRelationship.SOURCE] = doc
+        return nodes
+
+    def embed_nodes(self, nodes: list[BaseNode]):
+        texts = [node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+        embeddings = Settings.embed_model.get_text_embedding_batch(texts)
+        for node, embedding in zip(nodes, embeddings):
+            node.embedding = embedding
+
+    def write_nodes(self, nodes: list[BaseNode]):
+        if len(nodes) == 0:
+            return
+
+        self.vector_store._initialize()
+        rows = []
+        for node in nodes:
+            rows.append({
+                "node_id": node.node_id,
+                "embedding": node.get_embedding(),
+                "text": node.get_content(metadata_mode=MetadataMode.NONE),
+                "metadata_": node_to_metadata_dict(
+                    node, remove_text=True, flat_metadata=self.vector_store.flat_metadata),
+            })
+
+        with self.vector_store._session() as session, session.begin():
+            session.execute(insert(self.vector_store._table_class).values(rows))
+
+    def delete_docs(self, sources: list[str], batch_size=10000, vacuum=True) -> DeleteStats:
+        """
+        Delete all of the nodes of the sources with set-based statements, each statement deletes at most
+        batch_size rows to bound the lock time, then vacuum and analyze the table to reclaim the dead
+        rows and refresh the planner statistics.
+        """
+        if len(sources) == 0:
+            return DeleteStats()
+
+        self.vector_store._initialize()
+        table = self.vector_store._table_class
+
+        start_time = time.time()
+        stats = DeleteStats()
+        while True:
+            ids = select(table.id).where(table.metadata_["source"].astext.in_(sources)).limit(batch_size)
+            with self.vector_store._session() as session, session.begin():
+                result = session.execute(delete(table).where(table.id.in_(ids.scalar_subquery())))
+            stats.rows = stats.rows + result.rowcount
+            if result.rowcount < batch_size:
+                break
+        stats.elapsed = time.time() - start_time
+        logger.info("docs (sources=%s, rows=%d) were deleted, time used %.3fs", sources, stats.rows, stats.elapsed)
+
+        if vacuum and stats.rows > 0:
             start_time = time.time()
-            self.index.delete_ref_doc(doc_info.id, delete_from_docstore=True)
-            logger.info("doc (%s) was deleted, time used %.3fs", doc_info.name, (time.time() - start_time))
+            with self.vector_store._engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                conn.execute(text(f"VACUUM ANALYZE {self.vector_store.schema_name}.{table.__tablename__}"))
+            logger.info("table %s was vacuumed, time used %.3fs", table.__tablename__, (time.time() - start_time))
+        return stats
 
     def list_docs(self, source: str) -> list[DocInfo]:
         start_time = time.time()
-        nodes = self.vector_store.get_nodes(filters=MetadataFilters(
-            filters=[
-                MetadataFilter(key="source", value=source),
-            ],
-            condition="and",
-        ))
-        logger.info("docs (source=%s, total=%d) listed, time used %.3fs",
-                    source, len(nodes), (time.time() - start_time))
-
         docs = []
-        for node in nodes:
-            doc_id = node.ref_doc_id
-            existing, _ = self.doc_exists(docs, doc_id)
-            if existing:
-                continue
-            doc_name = node.extra_info["filename"]
-            doc_hash = node.extra_info["hash"]
-            docs.append(DocInfo(id=doc_id, name=doc_name, hash=doc_hash))
+        for page in self.iter_docs(source):
+            docs.extend(page)
+        logger.info("docs (source=%s, total=%d) listed, time used %.3fs",
+                    source, len(docs), (time.time() - start_time))
         return docs
 
+    def iter_docs(self, source: str, page_size=1000):
+        """
+        Yield the docs of the source page by page, only the doc id, filename and hash are fetched from the
+        node metadata, and the rows are streamed with a server-side cursor.
+        """
+        self.vector_store._initialize()
+        table = self.vector_store._table_class
+        statement = select(
+            table.metadata_["ref_doc_id"].astext.label("id"),
+            table.metadata_["filename"].astext.label("name"),
+            table.metadata_["hash"].astext.label("hash"),
+        ).where(table.metadata_["source"].astext == source).distinct()
+
+        doc_ids = set()
+        with self.vector_store._session() as session:
+            result = session.execute(statement.execution_options(yield_per=page_size))
+            for rows in result.partitions():
+                docs = []
+                for row in rows:
+                    if row.id in doc_ids:
+                        continue
+                    doc_ids.add(row.id)
+                    docs.append(DocInfo(id=row.id, name=row.name, hash=row.hash))
+                yield docs
+
     def retrieve(self, query: str, sources: list[str]=None) -> list[NodeWithScore]:
         if is_empty(query):
             return []
@@ -107,44 +415,38 @@ class RAGService:
         if sources is None:
             raise ValueError("sources are required")
 
-        metadata_filters = MetadataFilters(
-            filters=[
-                MetadataFilter(key="source", value=sources, operator="in"),
-            ],
-            condition="and",
-        )
-
-        retriever = self.index.as_retriever(
-            similarity_top_k=self.similarity_top_k,
-            vector_store_kwargs={"hnsw_ef_search": self.hnsw_ef_search},
-            filters=metadata_filters,
-        )
-        query_engine = RetrieverQueryEngine(retriever=retriever)
-
         logger.info("retrieve docs for %s (sources=%s)", query, sources)
         start_time = time.time()
-        response = query_engine.query(query)
-        logger.info("docs retrieved (total=%d, top_k=%d), time used %.3fs",
-                    len(response.source_nodes), self.similarity_top_k, (time.time() - start_time))
+        with span("embed"):
+            embedding = self.embed_cache.get_query_embedding(query)
+        with span("ann"):
+            retrieved_nodes = self.search(query, embedding, sources)
+        logger.info("docs retrieved (total=%d, top_k=%d, hybrid=%s), time used %.3fs",
+                    len(retrieved_nodes), self.similarity_top_k, self.hybrid_search, (time.time() - start_time))
         if logger.isEnabledFor(logging.DEBUG):
-            for node in response.source_nodes:
-                logger.debug("-- doc: [%.3f] %s", node.score, node.metadata["filename"])
+            for node in retrieved_nodes:
+                logger.debug("-- doc: [%.3f] %s", node.score or 0.0, node.metadata["filename"])
 
-        # similarity cutoff
-        processor = SimilarityPostprocessor(similarity_cutoff=self.similarity_cutoff)
-        filtered_nodes = processor.postprocess_nodes(response.source_nodes)
+        # similarity cutoff, the nodes that are only matched by the lexical search have no similarity, they
+        # are already cut to the top lexical_top_n lexical matches by hybrid_retrieve, and kept for the rerank
+        with span("cutoff"):
+            filtered_nodes = []
+            for node in retrieved_nodes:
+                if node.score is None or node.score >= self.similarity_cutoff:
+                    filtered_nodes.append(node)
         logger.info("filtered nodes (total=%d, cutoff=%0.2f)",
                      len(filtered_nodes), self.similarity_cutoff)
         if len(filtered_nodes) == 0:
+            incr("retrieve_empty")
             return []
         if logger.isEnabledFor(logging.DEBUG):
             for node in filtered_nodes:
-                logger.debug("-- doc: [%.3f] %s", node.score, node.metadata["filename"])
+                logger.debug("-- doc: [%.3f] %s", node.score or 0.0, node.metadata["filename"])
 
         # rerank
         start_time = time.time()
-        reranker = FlagEmbeddingReranker(model="BAAI/bge-reranker-large", top_n=self.rerank_top_n)
-        reranked_nodes = reranker.postprocess_nodes(filtered_nodes, query_str=query)
+        with span("rerank"):
+            reranked_nodes = self.reranker.rerank(filtered_nodes, query=query, top_n=self.rerank_top_n)
         logger.info("docs reranked (total=%d, top_n=%d), time used %.3fs",
                     len(reranked_nodes), self.rerank_top_n, (time.time() - start_time))
         if logger.isEnabledFor(logging.DEBUG):
@@ -157,8 +459,64 @@ class RAGService:
                 nodes.append(node)
         return nodes
 
-    def doc_exists(self, docs: list[DocInfo], doc_id: str):
-        for doc in docs:
-            if doc.id == doc_id:
-                return True, doc
-        return False, None
+    def search(self, query: str, embedding: list[float], sources: list[str]) -> list[NodeWithScore]:
+        """
+        The source-filtered ANN (or hybrid) search of the query, before the similarity cutoff and the rerank.
+        """
+        metadata_filters = MetadataFilters(
+            filters=[
+                MetadataFilter(key="source", value=sources, operator="in"),
+            ],
+            condition="and",
+        )
+        if self.hybrid_search:
+            return self.hybrid_retrieve(query, embedding, metadata_filters)
+
+        retriever = self.index.as_retriever(
+            similarity_top_k=self.similarity_top_k,
+            vector_store_kwargs={"hnsw_ef_search": self.hnsw_ef_search},
+            filters=metadata_filters,
+        )
+        query_engine = RetrieverQueryEngine(retriever=retriever)
+        response = query_engine.query(QueryBundle(query_str=query, embedding=embedding))
+        return response.source_nodes
+
+    def hybrid_retrieve(self, query: str, embedding: list[float], filters: MetadataFilters) -> list[NodeWithScore]:
+        """
+        Run the lexical (full-text) search and the vector search concurrently, and merge them with the
+        reciprocal rank fusion, the nodes are ordered by the fused rank, and their scores are the vector
+        similarities. The nodes that are only matched by the lexical search have no similarity, so they
+        are kept only if they are in the top lexical_top_n lexical matches, and have no score.
+        """
+        sparse_future = self._executor.submit(self.vector_store.query, VectorStoreQuery(
+            query_str=query,
+            similarity_top_k=self.similarity_top_k,
+            sparse_top_k=self.similarity_top_k,
+            filters=filters,
+            mode=VectorStoreQueryMode.TEXT_SEARCH,
+        ))
+        dense_result = self.vector_store.query(VectorStoreQuery(
+            query_embedding=embedding,
+            similarity_top_k=self.similarity_top_k,
+            filters=filters,
+        ), hnsw_ef_search=self.hnsw_ef_search)
+        sparse_result = sparse_future.result()
+
+        nodes = {}
+        similarities = {}
+        fused_scores = {}
+        for result in (dense_result, sparse_result):
+            for rank, (node_id, node) in enumerate(zip(result.ids, result.nodes)):
+                nodes.setdefault(node_id, node)
+                fused_scores[node_id] = fused_scores.get(node_id, 0.0) + 1.0 / (self.rrf_k + rank + 1)
+        for node_id, similarity in zip(dense_result.ids, dense_result.similarities):
+            similarities[node_id] = similarity
+        for node_id in sparse_result.ids[self.lexical_top_n:]:
+            if node_id not in similarities:
+                del fused_scores[node_id]
+        logger.debug("hybrid retrieved (dense=%d, sparse=%d, fused=%d)",
+                     len(dense_result.ids), len(sparse_result.ids), len(fused_scores))
+
+        ranked_ids = sorted(fused_scores, key=lambda node_id: fused_scores[node_id], reverse=True)
+        return [NodeWithScore(node=nodes[node_id], score=similarities.get(node_id))
+                for node_id in ranked_ids[:self.similarity_top_k]]
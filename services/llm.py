@@ -6,31 +6,67 @@
 The service to invoke the LLM
 """
 
-import dspy
 import logging
 from models.contexts import LLMConfig, RetrievalConfig
 from models.chat import Record
 from services.storage import Response
+from tools.lm import LMRegistry
 from workflows.self_rag_graph import build_self_rag_graph
+from workflows.self_rag.context import ContextBudget
+from workflows.self_rag.nodes import RetrieveCounters
 from workflows.self_rag.state import new_state
 
 logger = logging.getLogger(__name__)
 
 class LLMService:
-    def __init__(self, rag_svc):
-        self.resp_graph = build_self_rag_graph(rag_svc=rag_svc)
+    def __init__(self, rag_svc, budget: ContextBudget=None, lm_registry: LMRegistry=None, speculative_rewrite=False,
+                 rewrite_workers=4):
+        self.lm_registry = lm_registry if lm_registry is not None else LMRegistry()
+        self.budget = budget if budget is not None else ContextBudget()
+        self.retrieve_counters = RetrieveCounters()
+        self.resp_graph = build_self_rag_graph(rag_svc=rag_svc, budget=self.budget,
+                                               speculative=speculative_rewrite, counters=self.retrieve_counters,
+                                               rewrite_workers=rewrite_workers)
 
     def response(self, mcfg: LLMConfig, rcfg: RetrievalConfig,
-                 query: str, history_resps: list[Response], recursion_limit=50):
-        lm = dspy.LM(model=mcfg.model, api_base=mcfg.api_base, api_key=mcfg.api_key)
-        dspy.configure(lm=lm)
-
-        history_records = []
-        for resp in history_resps:
-            history_records.append(Record(role="user", message=resp.user_query))
-            history_records.append(Record(role="assistant", message=resp.asst_resp))
-
-        return self.resp_graph.invoke(
-            new_state(doc_sources=rcfg.doc_sources, query=query, history_records=history_records),
-            config={"recursion_limit": recursion_limit},
-        )
+                 query: str, history_resps: list[Response], history_summary="", recursion_limit=50):
+        # the graph runs the nodes in the current thread, so they use the LM of this request
+        with self.lm_registry.context(mcfg):
+            return self.resp_graph.invoke(
+                new_state(doc_sources=rcfg.doc_sources, query=query, history_records=to_records(history_resps),
+                          history_summary=history_summary),
+                config={"recursion_limit": recursion_limit},
+            )
+
+    def stream_response(self, mcfg: LLMConfig, rcfg: RetrievalConfig, query: str, history_resps: list[Response],
+                        history_summary="", recursion_limit=50):
+        """
+        Stream the response of the self RAG graph, yield ("stage", event) for the retrieval stages,
+        ("reasoning", delta) and ("response", delta) as the LLM produces the tokens, and ("state", the
+        final state) at last.
+        """
+        with self.lm_registry.context(mcfg):
+            state = None
+            for mode, chunk in self.resp_graph.stream(
+                new_state(doc_sources=rcfg.doc_sources, query=query, history_records=to_records(history_resps),
+                          history_summary=history_summary),
+                config={"recursion_limit": recursion_limit, "configurable": {"stream": True}},
+                stream_mode=["custom", "values"],
+            ):
+                if mode == "custom":
+                    yield chunk
+                else:
+                    state = chunk
+
+        # the terminated graph does not answer, so its response is not streamed
+        if state["terminated"]:
+            yield "reasoning", state["reasoning"]
+            yield "response", state["response"]
+        yield "state", state
+
+def to_records(history_resps: list[Response]) -> list[Record]:
+    history_records = []
+    for resp in history_resps:
+        history_records.append(Record(role="user", message=resp.user_query))
+        history_records.append(Record(role="assistant", message=resp.asst_resp))
+    return history_records
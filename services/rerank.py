@@ -0,0 +1,155 @@
+# coding: utf-8
+
+# pylint: disable=missing-class-docstring
+
+"""
+The service to rerank the retrieved nodes
+"""
+
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from FlagEmbedding import FlagReranker
+from llama_index.core.schema import MetadataMode, NodeWithScore
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+class RerankMetrics(BaseModel):
+    queue_depth: int = 0
+    batches: int = 0
+    pairs: int = 0
+    last_batch_size: int = 0
+    max_batch_size: int = 0
+    avg_batch_size: float = 0.0
+
+class RerankTask:
+    def __init__(self, pairs: list[tuple[str, str]]):
+        self.pairs = pairs
+        self.future = Future()
+
+class RerankService:
+    """
+    A long-lived reranker, the model is loaded once, and the query-passage pairs from concurrent
+    requests are gathered into micro-batches by a background worker.
+      - max_batch_size: the maximum number of pairs in one micro-batch, a request with more pairs than
+            this is scored in its own batch.
+      - max_wait_ms: the maximum time that the worker waits for more pairs after the first pair of a
+            micro-batch arrives.
+    """
+
+    def __init__(self, model="BAAI/bge-reranker-large", use_fp16=False,
+                 max_batch_size=32, max_wait_ms=10, timeout=120):
+        start_time = time.time()
+        self.model = model
+        self._reranker = FlagReranker(model, use_fp16=use_fp16)
+        logger.info("reranker %s is loaded, time used %.3fs", model, (time.time() - start_time))
+
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.timeout = timeout
+
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._metrics = RerankMetrics()
+        self._worker = threading.Thread(target=self._run, name="reranker", daemon=True)
+        self._worker.start()
+
+    def rerank(self, nodes: list[NodeWithScore], query: str, top_n: int) -> list[NodeWithScore]:
+        if len(nodes) == 0:
+            return []
+
+        pairs = [(query, node.node.get_content(metadata_mode=MetadataMode.EMBED)) for node in nodes]
+        scores = self.score(pairs)
+        for node, score in zip(nodes, scores):
+            node.score = score
+
+        return sorted(nodes, key=lambda x: -x.score if x.score else 0)[:top_n]
+
+    def score(self, pairs: list[tuple[str, str]]) -> list[float]:
+        if len(pairs) == 0:
+            return []
+
+        task = RerankTask(pairs)
+        self._queue.put(task)
+        return task.future.result(timeout=self.timeout)
+
+    def metrics(self) -> RerankMetrics:
+        with self._lock:
+            metrics = self._metrics.model_copy()
+        metrics.queue_depth = self._queue.qsize()
+        return metrics
+
+    def close(self):
+        self._queue.put(None)
+        self._worker.join()
+
+    def _run(self):
+        pending = None
+        stopped = False
+        while not stopped:
+            task = pending if pending is not None else self._queue.get()
+            pending = None
+            if task is None:
+                break
+
+            # gather the pairs from the other requests until the batch is full or the wait is over
+            batch = [task]
+            batch_size = len(task.pairs)
+            deadline = time.monotonic() + self.max_wait
+            while batch_size < self.max_batch_size:
+                wait = deadline - time.monotonic()
+                if wait <= 0:
+                    break
+
+                try:
+                    task = self._queue.get(timeout=wait)
+                except queue.Empty:
+                    break
+
+                if task is None:
+                    stopped = True
+                    break
+
+                if batch_size + len(task.pairs) > self.max_batch_size:
+                    pending = task
+                    break
+
+                batch.append(task)
+                batch_size = batch_size + len(task.pairs)
+
+            self._score_batch(batch, batch_size)
+
+    def _score_batch(self, batch: list[RerankTask], batch_size: int):
+        pairs = []
+        for task in batch:
+            pairs.extend(task.pairs)
+
+        start_time = time.time()
+        try:
+            scores = self._reranker.compute_score(pairs, batch_size=max(batch_size, 1))
+        except Exception as e: # pylint: disable=broad-exception-caught
+            logger.error("failed to rerank the batch (requests=%d, pairs=%d), %s", len(batch), batch_size, e)
+            for task in batch:
+                task.future.set_exception(e)
+            return
+
+        # a single pair passed into compute_score returns a float
+        if isinstance(scores, float):
+            scores = [scores]
+
+        offset = 0
+        for task in batch:
+            task.future.set_result(scores[offset:offset + len(task.pairs)])
+            offset = offset + len(task.pairs)
+
+        with self._lock:
+            self._metrics.batches = self._metrics.batches + 1
+            self._metrics.pairs = self._metrics.pairs + batch_size
+            self._metrics.last_batch_size = batch_size
+            self._metrics.max_batch_size = max(self._metrics.max_batch_size, batch_size)
+            self._metrics.avg_batch_size = self._metrics.pairs / self._metrics.batches
+        logger.debug("batch reranked (requests=%d, pairs=%d, queue_depth=%d), time used %.3fs",
+                     len(batch), batch_size, self._queue.qsize(), (time.time() - start_time))
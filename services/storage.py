@@ -6,9 +6,20 @@
 The service to store the chat records
 """
 
+import threading
 import uuid
-from datetime import datetime, timezone
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from pgvector.sqlalchemy import Vector
+from sqlalchemy import Connection, Index, bindparam, delete, func, make_url, or_, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlmodel import Column, JSON, SQLModel, Session, Field, create_engine, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from pydantic import BaseModel
+from models.contexts import LLMConfig, RetrievalConfig
+from tools.embeddings.huggingface import BGE
 
 class Context(SQLModel, table=True):
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
@@ -27,6 +38,9 @@ class Response(SQLModel, table=True):
     asst_resp: str | None = None
     reasoning: str | None = None
     referenced_docs: list[str] | None = Field(default=None, sa_column=Column(JSON))
+    # the cached response that is served as this response, so the evaluations of the served copies
+    # are applied to the cached response
+    cached_resp_id: uuid.UUID | None = Field(default=None, index=True)
     create_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), nullable=False)
     update_at: datetime = Field(
         default_factory=lambda: datetime.now(timezone.utc),
@@ -35,6 +49,17 @@ class Response(SQLModel, table=True):
     )
     issue_id: uuid.UUID = Field(nullable=False, foreign_key="issue.id", ondelete="CASCADE")
 
+class IssueSummary(SQLModel, table=True):
+    id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
+    summary: str
+    turns: int = 0
+    update_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc),
+        nullable=False,
+        sa_column_kwargs={"onupdate": lambda: datetime.now(timezone.utc)},
+    )
+    issue_id: uuid.UUID = Field(nullable=False, unique=True, foreign_key="issue.id", ondelete="CASCADE")
+
 class Evaluation(SQLModel, table=True):
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
     score: int
@@ -43,6 +68,13 @@ class Evaluation(SQLModel, table=True):
     issue_id: uuid.UUID = Field(nullable=False, foreign_key="issue.id", ondelete="CASCADE")
     resp_id: uuid.UUID = Field(nullable=False, foreign_key="response.id", ondelete="CASCADE")
 
+class AnswerCache(SQLModel, table=True):
+    id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
+    doc_sources: str = Field(index=True)
+    query_embedding: list[float] = Field(sa_column=Column(Vector(BGE.dims)))
+    create_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), nullable=False)
+    resp_id: uuid.UUID = Field(nullable=False, foreign_key="response.id", ondelete="CASCADE")
+
 class RunbookSet(SQLModel, table=True):
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
     repo: str
@@ -56,10 +88,157 @@ class RunbookSetVersion(SQLModel, table=True):
     create_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), nullable=False)
     runbook_set_id: uuid.UUID = Field(nullable=False, foreign_key="runbookset.id", ondelete="CASCADE")
 
+class IndexJob(SQLModel, table=True):
+    # at most one queued or running job per runbook set, so a repo is never indexed twice at the same time
+    __table_args__ = (
+        Index("ix_indexjob_active_runbook_set", "runbook_set_id", unique=True,
+              postgresql_where=text("state IN ('queued', 'running')")),
+    )
+
+    id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
+    repo_dir: str
+    version: str
+    # queued, running, done or failed
+    state: str = "queued"
+    attempts: int = 0
+    max_attempts: int = 3
+    error: str | None = None
+    progress: dict | None = Field(default=None, sa_column=Column(JSON))
+    worker: str | None = None
+    lease_until: datetime | None = None
+    run_after: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), nullable=False)
+    create_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), nullable=False)
+    update_at: datetime = Field(
+        default_factory=lambda: datetime.now(timezone.utc),
+        nullable=False,
+        sa_column_kwargs={"onupdate": lambda: datetime.now(timezone.utc)},
+    )
+    runbook_set_id: uuid.UUID = Field(nullable=False, foreign_key="runbookset.id", ondelete="CASCADE")
+
+class IssueSnapshot(BaseModel):
+    issue: Issue
+    context: Context | None = None
+    responses: list[Response] = []
+
+class ContextCache:
+    """
+    A bounded LRU cache of the parsed issue contexts, keyed by the issue id, the context of an issue is
+    never changed after the issue is created, so the entries are never stale.
+    """
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[uuid.UUID, tuple[LLMConfig, RetrievalConfig]] = OrderedDict()
+
+    def get(self, issue_id: uuid.UUID) -> tuple[LLMConfig, RetrievalConfig]:
+        with self._lock:
+            entry = self._entries.get(issue_id)
+            if entry is not None:
+                self._entries.move_to_end(issue_id)
+            return entry
+
+    def put(self, issue_id: uuid.UUID, mcfg: LLMConfig, rcfg: RetrievalConfig):
+        with self._lock:
+            self._entries[issue_id] = (mcfg, rcfg)
+            self._entries.move_to_end(issue_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+def migrate(conn: Connection):
+    # the columns that are added after the tables are created, create_all does not alter the tables
+    conn.execute(text("ALTER TABLE response ADD COLUMN IF NOT EXISTS cached_resp_id uuid"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_response_cached_resp_id ON response (cached_resp_id)"))
+    dims = conn.execute(text("SELECT atttypmod FROM pg_attribute "
+                             "WHERE attrelid = 'answercache'::regclass AND attname = 'query_embedding'")).scalar()
+    if dims == -1:
+        conn.execute(text(f"ALTER TABLE answercache ALTER COLUMN query_embedding TYPE vector({BGE.dims})"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_answercache_query_embedding ON answercache "
+                      "USING hnsw (query_embedding vector_cosine_ops)"))
+
+# the doc_sources and the dislike filters are applied after the HNSW scan, which returns ef_search
+# candidates at most, so the scan is iterated until a candidate passes the filters, in the distance
+# order, as only the nearest one is returned
+ITERATIVE_SCAN = text("SET LOCAL hnsw.iterative_scan = strict_order")
+
+# fail the running jobs whose lease is expired and that are out of attempts, with their versions
+FAIL_EXPIRED_INDEX_JOBS = text("""
+    WITH expired AS (
+        UPDATE indexjob SET state = 'failed', error = 'the lease of the worker is expired',
+            lease_until = NULL, update_at = now()
+        WHERE state = 'running' AND lease_until < now() AND attempts >= max_attempts
+        RETURNING runbook_set_id, version
+    )
+    UPDATE runbooksetversion SET state = 'failed' FROM expired
+    WHERE runbooksetversion.runbook_set_id = expired.runbook_set_id
+        AND runbooksetversion.version = expired.version
+""")
+
+CLAIM_INDEX_JOB = text("""
+    UPDATE indexjob SET state = 'running', worker = :worker, attempts = attempts + 1,
+        lease_until = now() + make_interval(secs => :lease_seconds), update_at = now()
+    WHERE id = (
+        SELECT id FROM indexjob
+        WHERE (state = 'queued' AND run_after <= now()) OR (state = 'running' AND lease_until < now())
+        ORDER BY create_at
+        FOR UPDATE SKIP LOCKED
+        LIMIT 1
+    )
+    RETURNING id
+""")
+
+UPDATE_INDEX_JOB = text("""
+    UPDATE indexjob SET progress = :progress,
+        lease_until = now() + make_interval(secs => :lease_seconds), update_at = now()
+    WHERE id = :id AND state = 'running' AND worker = :worker
+""").bindparams(bindparam("progress", type_=JSON))
+
+def finish_job(job: IndexJob, error: str, retry_delay: int):
+    if error is None:
+        job.state = "done"
+    elif job.attempts < job.max_attempts:
+        job.state = "queued"
+        job.run_after = datetime.now(timezone.utc) + timedelta(seconds=retry_delay * job.attempts)
+    else:
+        job.state = "failed"
+    job.error = error
+    job.lease_until = None
+
+def disliked_statement():
+    # the disliked responses, a disliked copy of a cached response dislikes the cached response
+    resp = aliased(Response)
+    return select(func.coalesce(resp.cached_resp_id, resp.id)).\
+        join(Evaluation, Evaluation.resp_id == resp.id).\
+        where(Evaluation.score < 0)
+
+def snapshot_statement(issue_id: uuid.UUID, with_context: bool):
+    # the issue, its context and its ordered responses are loaded by one joined query
+    if with_context:
+        statement = select(Issue, Context, Response).outerjoin(Context, Context.issue_id == Issue.id)
+    else:
+        statement = select(Issue, Response)
+    return statement.\
+        outerjoin(Response, Response.issue_id == Issue.id).\
+        where(Issue.id == issue_id).\
+        order_by(Response.create_at)
+
+def to_snapshot(rows, with_context: bool) -> IssueSnapshot:
+    if len(rows) == 0:
+        return None
+
+    issue = rows[0][0]
+    context = rows[0][1] if with_context else None
+    responses = [row[-1] for row in rows if row[-1] is not None]
+    return IssueSnapshot(issue=issue, context=context, responses=responses)
+
 class StorageService:
     def __init__(self, db_url: str):
         engine = create_engine(url=db_url, echo=False)
+        with engine.begin() as conn:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
         SQLModel.metadata.create_all(engine)
+        with engine.begin() as conn:
+            migrate(conn)
         self.engine = engine
 
     def create_context(self, issue_id: uuid.UUID, retrieval_cfg: str, llm_cfg: str):
@@ -90,10 +269,11 @@ class StorageService:
         with Session(self.engine) as session:
             return session.exec(statement=select(Issue), execution_options={"prebuffer_rows": True})
 
-    def create_resp(self, issue_id:str, user_query: str, asst_resp: str, reasoning: str, referenced_docs: list[str]):
+    def create_resp(self, issue_id:str, user_query: str, asst_resp: str, reasoning: str, referenced_docs: list[str],
+                    cached_resp_id: uuid.UUID=None):
         resp = Response(user_query=user_query, asst_resp=asst_resp,
                         reasoning=reasoning, referenced_docs=referenced_docs,
-                        issue_id=issue_id)
+                        cached_resp_id=cached_resp_id, issue_id=issue_id)
         with Session(self.engine) as session:
             session.add(resp)
             session.commit()
@@ -109,12 +289,76 @@ class StorageService:
             statement = select(Response).where(Response.issue_id == issue_id).order_by(Response.create_at)
             return session.exec(statement=statement, execution_options={"prebuffer_rows": True})
 
+    def load_issue_snapshot(self, issue_id: uuid.UUID, with_context=True) -> IssueSnapshot:
+        """
+        Load the issue, its context (unless with_context is False) and its ordered responses in one
+        round trip, return None if the issue is not found.
+        """
+        with Session(self.engine) as session:
+            rows = session.exec(snapshot_statement(issue_id, with_context)).all()
+            return to_snapshot(rows, with_context)
+
+    def find_issue_summary(self, issue_id: uuid.UUID) -> IssueSummary:
+        with Session(self.engine) as session:
+            statement = select(IssueSummary).where(IssueSummary.issue_id == issue_id)
+            results = session.exec(statement)
+            return results.first()
+
+    def save_issue_summary(self, issue_id: uuid.UUID, summary: str, turns: int) -> IssueSummary:
+        with Session(self.engine) as session:
+            statement = select(IssueSummary).where(IssueSummary.issue_id == issue_id)
+            issue_summary = session.exec(statement).first()
+            if issue_summary is None:
+                issue_summary = IssueSummary(issue_id=issue_id, summary=summary, turns=turns)
+            else:
+                issue_summary.summary = summary
+                issue_summary.turns = turns
+            session.add(issue_summary)
+            session.commit()
+            session.refresh(issue_summary)
+            return issue_summary
+
     def evaluate(self, issue_id: uuid.UUID, resp_id: uuid.UUID, score: int, feedback: str = None):
         evaluation = Evaluation(score=score, feedback=feedback, issue_id=issue_id, resp_id=resp_id)
         with Session(self.engine) as session:
             session.add(evaluation)
             session.commit()
 
+    def add_cached_answer(self, resp_id: uuid.UUID, doc_sources: str, query_embedding: list[float]):
+        cached_answer = AnswerCache(resp_id=resp_id, doc_sources=doc_sources, query_embedding=query_embedding)
+        with Session(self.engine) as session:
+            session.add(cached_answer)
+            session.commit()
+
+    def find_cached_answer(self, doc_sources: str, query_embedding: list[float]) -> tuple[Response, float]:
+        distance = AnswerCache.query_embedding.cosine_distance(query_embedding).label("distance")
+        disliked_resps = disliked_statement()
+        with Session(self.engine) as session:
+            session.execute(ITERATIVE_SCAN)
+            statement = select(Response, distance).\
+                join(AnswerCache, AnswerCache.resp_id == Response.id).\
+                where(AnswerCache.doc_sources == doc_sources).\
+                where(Response.id.not_in(disliked_resps)).\
+                order_by(distance).\
+                limit(1)
+            result = session.exec(statement).first()
+            if result is None:
+                return None, 0.0
+            resp, resp_distance = result
+            return resp, 1 - resp_distance
+
+    def delete_cached_answers(self, source: str) -> int:
+        with Session(self.engine) as session:
+            statement = delete(AnswerCache).where(or_(
+                AnswerCache.doc_sources == source,
+                AnswerCache.doc_sources.startswith(f"{source},"),
+                AnswerCache.doc_sources.endswith(f",{source}"),
+                AnswerCache.doc_sources.contains(f",{source},"),
+            ))
+            result = session.exec(statement)
+            session.commit()
+            return result.rowcount
+
     def create_runbook_set(self, repo: str, branch: str) -> RunbookSet:
         runbook_set = RunbookSet(repo=repo, branch=branch)
         with Session(self.engine) as session:
@@ -168,3 +412,342 @@ class StorageService:
                 order_by(RunbookSetVersion.create_at)
             results = session.exec(statement=statement, execution_options={"prebuffer_rows": True})
             return results
+
+    def enqueue_index_job(self, runbook_set_id: uuid.UUID, repo_dir: str, version: str,
+                          max_attempts=3) -> tuple[IndexJob, bool]:
+        """
+        Enqueue an index job of the runbook set, if the runbook set has a queued or running job already,
+        the job is returned instead, and the second value is False.
+        """
+        job = IndexJob(runbook_set_id=runbook_set_id, repo_dir=repo_dir, version=version, max_attempts=max_attempts)
+        with Session(self.engine) as session:
+            session.add(job)
+            try:
+                session.commit()
+            except IntegrityError:
+                session.rollback()
+                return self.find_active_index_job(runbook_set_id), False
+            session.refresh(job)
+            return job, True
+
+    def claim_index_job(self, worker: str, lease_seconds: int) -> IndexJob:
+        """
+        Claim the oldest runnable job, a queued job or a running job whose lease is expired (its worker
+        is gone), the row is locked with SKIP LOCKED, so the concurrent workers never claim the same job.
+        The running jobs that are out of attempts are failed first.
+        """
+        with self.engine.begin() as conn:
+            conn.execute(FAIL_EXPIRED_INDEX_JOBS)
+            job_id = conn.execute(CLAIM_INDEX_JOB, {"worker": worker, "lease_seconds": lease_seconds}).scalar()
+        if job_id is None:
+            return None
+        with Session(self.engine) as session:
+            return session.get(IndexJob, job_id)
+
+    def update_index_job(self, job_id: uuid.UUID, worker: str, progress: dict, lease_seconds: int) -> bool:
+        """
+        Save the progress of a running job and extend the lease of its worker, it is False if the job is
+        not running on the worker anymore, e.g. its runbook set is deleted or its lease is expired and it
+        is claimed by another worker.
+        """
+        with self.engine.begin() as conn:
+            result = conn.execute(UPDATE_INDEX_JOB, {"id": job_id, "worker": worker, "progress": progress,
+                                                     "lease_seconds": lease_seconds})
+            return result.rowcount > 0
+
+    def finish_index_job(self, job_id: uuid.UUID, worker: str, error: str=None, retry_delay=60) -> IndexJob:
+        """
+        Finish a running job of the worker, a failed job is queued again after retry_delay * attempts
+        seconds until it is out of attempts.
+        """
+        with Session(self.engine) as session:
+            statement = select(IndexJob).\
+                where(IndexJob.id == job_id, IndexJob.state == "running", IndexJob.worker == worker).\
+                with_for_update()
+            job = session.exec(statement).first()
+            if job is None:
+                return None
+
+            finish_job(job, error, retry_delay)
+            session.add(job)
+            session.commit()
+            session.refresh(job)
+            return job
+
+    def find_active_index_job(self, runbook_set_id: uuid.UUID) -> IndexJob:
+        with Session(self.engine) as session:
+            statement = select(IndexJob).where(IndexJob.runbook_set_id == runbook_set_id,
+                                               IndexJob.state.in_(["queued", "running"]))
+            return session.exec(statement).first()
+
+    def find_latest_index_job(self, runbook_set_id: uuid.UUID) -> IndexJob:
+        with Session(self.engine) as session:
+            statement = select(IndexJob).\
+                where(IndexJob.runbook_set_id == runbook_set_id).\
+                order_by(IndexJob.create_at.desc())
+            return session.exec(statement).first()
+
+class AsyncStorageService:
+    """
+    The async variant of StorageService on asyncpg, it runs the same statements without blocking the
+    event loop, over a tunable connection pool.
+      - pool_size: the number of the connections that are kept in the pool.
+      - max_overflow: the number of the connections that can be opened beyond pool_size under load.
+      - pool_pre_ping: test a connection before it is checked out, so the stale connections are replaced.
+      - statement_cache_size: the size of the prepared statement cache per connection, set it to 0
+            behind a transaction-mode pgbouncer.
+    """
+
+    def __init__(self, db_url: str, pool_size=10, max_overflow=10, pool_pre_ping=True, pool_recycle=1800,
+                 statement_cache_size=100):
+        url = make_url(db_url).set(drivername="postgresql+asyncpg")
+        url = url.update_query_dict({"prepared_statement_cache_size": str(statement_cache_size)})
+        self.engine = create_async_engine(
+            url,
+            echo=False,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_pre_ping=pool_pre_ping,
+            pool_recycle=pool_recycle,
+            connect_args={"statement_cache_size": statement_cache_size},
+        )
+        # the objects are used after the session is closed, so they are not expired on commit
+        self.session = async_sessionmaker(self.engine, class_=AsyncSession, expire_on_commit=False)
+
+    async def init(self):
+        async with self.engine.begin() as conn:
+            await conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
+            await conn.run_sync(SQLModel.metadata.create_all)
+            await conn.run_sync(migrate)
+
+    async def close(self):
+        await self.engine.dispose()
+
+    async def create_context(self, issue_id: uuid.UUID, retrieval_cfg: str, llm_cfg: str):
+        ctx = Context(retrieval_config=retrieval_cfg, llm_config=llm_cfg, issue_id=issue_id)
+        async with self.session() as session:
+            session.add(ctx)
+            await session.commit()
+
+    async def find_context(self, issue_id: uuid.UUID) -> Context:
+        async with self.session() as session:
+            statement = select(Context).where(Context.issue_id == issue_id)
+            results = await session.exec(statement)
+            return results.first()
+
+    async def create_issue(self, name: str) -> Issue:
+        issue = Issue(name=name)
+        async with self.session() as session:
+            session.add(issue)
+            await session.commit()
+            await session.refresh(issue)
+            return issue
+
+    async def get_issue(self, uid: uuid.UUID) -> Issue:
+        async with self.session() as session:
+            return await session.get(Issue, uid)
+
+    async def list_issue(self) -> list[Issue]:
+        async with self.session() as session:
+            results = await session.exec(select(Issue))
+            return results.all()
+
+    async def create_resp(self, issue_id:str, user_query: str, asst_resp: str, reasoning: str,
+                          referenced_docs: list[str], cached_resp_id: uuid.UUID=None) -> Response:
+        resp = Response(user_query=user_query, asst_resp=asst_resp,
+                        reasoning=reasoning, referenced_docs=referenced_docs,
+                        cached_resp_id=cached_resp_id, issue_id=issue_id)
+        async with self.session() as session:
+            session.add(resp)
+            await session.commit()
+            await session.refresh(resp)
+            return resp
+
+    async def get_resp(self, uid: uuid.UUID) -> Response:
+        async with self.session() as session:
+            return await session.get(Response, uid)
+
+    async def list_resp(self, issue_id: uuid.UUID) -> list[Response]:
+        async with self.session() as session:
+            statement = select(Response).where(Response.issue_id == issue_id).order_by(Response.create_at)
+            results = await session.exec(statement)
+            return results.all()
+
+    async def load_issue_snapshot(self, issue_id: uuid.UUID, with_context=True) -> IssueSnapshot:
+        async with self.session() as session:
+            rows = (await session.exec(snapshot_statement(issue_id, with_context))).all()
+            return to_snapshot(rows, with_context)
+
+    async def find_issue_summary(self, issue_id: uuid.UUID) -> IssueSummary:
+        async with self.session() as session:
+            statement = select(IssueSummary).where(IssueSummary.issue_id == issue_id)
+            results = await session.exec(statement)
+            return results.first()
+
+    async def save_issue_summary(self, issue_id: uuid.UUID, summary: str, turns: int) -> IssueSummary:
+        async with self.session() as session:
+            statement = select(IssueSummary).where(IssueSummary.issue_id == issue_id)
+            issue_summary = (await session.exec(statement)).first()
+            if issue_summary is None:
+                issue_summary = IssueSummary(issue_id=issue_id, summary=summary, turns=turns)
+            else:
+                issue_summary.summary = summary
+                issue_summary.turns = turns
+            session.add(issue_summary)
+            await session.commit()
+            await session.refresh(issue_summary)
+            return issue_summary
+
+    async def evaluate(self, issue_id: uuid.UUID, resp_id: uuid.UUID, score: int, feedback: str = None):
+        evaluation = Evaluation(score=score, feedback=feedback, issue_id=issue_id, resp_id=resp_id)
+        async with self.session() as session:
+            session.add(evaluation)
+            await session.commit()
+
+    async def add_cached_answer(self, resp_id: uuid.UUID, doc_sources: str, query_embedding: list[float]):
+        cached_answer = AnswerCache(resp_id=resp_id, doc_sources=doc_sources, query_embedding=query_embedding)
+        async with self.session() as session:
+            session.add(cached_answer)
+            await session.commit()
+
+    async def find_cached_answer(self, doc_sources: str, query_embedding: list[float]) -> tuple[Response, float]:
+        distance = AnswerCache.query_embedding.cosine_distance(query_embedding).label("distance")
+        disliked_resps = disliked_statement()
+        async with self.session() as session:
+            await session.execute(ITERATIVE_SCAN)
+            statement = select(Response, distance).\
+                join(AnswerCache, AnswerCache.resp_id == Response.id).\
+                where(AnswerCache.doc_sources == doc_sources).\
+                where(Response.id.not_in(disliked_resps)).\
+                order_by(distance).\
+                limit(1)
+            result = (await session.exec(statement)).first()
+            if result is None:
+                return None, 0.0
+            resp, resp_distance = result
+            return resp, 1 - resp_distance
+
+    async def delete_cached_answers(self, source: str) -> int:
+        async with self.session() as session:
+            statement = delete(AnswerCache).where(or_(
+                AnswerCache.doc_sources == source,
+                AnswerCache.doc_sources.startswith(f"{source},"),
+                AnswerCache.doc_sources.endswith(f",{source}"),
+                AnswerCache.doc_sources.contains(f",{source},"),
+            ))
+            result = await session.exec(statement)
+            await session.commit()
+            return result.rowcount
+
+    async def create_runbook_set(self, repo: str, branch: str) -> RunbookSet:
+        runbook_set = RunbookSet(repo=repo, branch=branch)
+        async with self.session() as session:
+            session.add(runbook_set)
+            await session.commit()
+            await session.refresh(runbook_set)
+            return runbook_set
+
+    async def delete_runbook_set(self, runbook_set: RunbookSet):
+        async with self.session() as session:
+            await session.delete(runbook_set)
+            await session.commit()
+
+    async def get_runbook_set(self, uid: uuid.UUID) -> RunbookSet:
+        async with self.session() as session:
+            return await session.get(RunbookSet, uid)
+
+    async def list_runbook_set(self) -> list[RunbookSet]:
+        async with self.session() as session:
+            results = await session.exec(select(RunbookSet))
+            return results.all()
+
+    async def find_runbook_set(self, repo: str, branch: str) -> RunbookSet:
+        async with self.session() as session:
+            statement = select(RunbookSet).where(RunbookSet.repo == repo, RunbookSet.branch == branch)
+            results = await session.exec(statement)
+            return results.first()
+
+    async def add_runbook_set_version(self, runbook_set_id: uuid.UUID, version: str) -> RunbookSetVersion:
+        rsv = RunbookSetVersion(version=version, state="indexing", runbook_set_id=runbook_set_id)
+        async with self.session() as session:
+            session.add(rsv)
+            await session.commit()
+            await session.refresh(rsv)
+            return rsv
+
+    async def update_runbook_set_version(self, rsv: RunbookSetVersion):
+        async with self.session() as session:
+            session.add(rsv)
+            await session.commit()
+
+    async def find_runbook_set_version(self, version: str) -> RunbookSetVersion:
+        async with self.session() as session:
+            statement = select(RunbookSetVersion).where(RunbookSetVersion.version == version)
+            results = await session.exec(statement)
+            return results.first()
+
+    async def list_runbook_set_versions(self, rs_id: uuid.UUID) -> list[RunbookSetVersion]:
+        async with self.session() as session:
+            statement = select(RunbookSetVersion).\
+                where(RunbookSetVersion.runbook_set_id == rs_id).\
+                order_by(RunbookSetVersion.create_at)
+            results = await session.exec(statement)
+            return results.all()
+
+    async def enqueue_index_job(self, runbook_set_id: uuid.UUID, repo_dir: str, version: str,
+                                max_attempts=3) -> tuple[IndexJob, bool]:
+        job = IndexJob(runbook_set_id=runbook_set_id, repo_dir=repo_dir, version=version, max_attempts=max_attempts)
+        async with self.session() as session:
+            session.add(job)
+            try:
+                await session.commit()
+            except IntegrityError:
+                await session.rollback()
+                return await self.find_active_index_job(runbook_set_id), False
+            await session.refresh(job)
+            return job, True
+
+    async def claim_index_job(self, worker: str, lease_seconds: int) -> IndexJob:
+        async with self.engine.begin() as conn:
+            await conn.execute(FAIL_EXPIRED_INDEX_JOBS)
+            job_id = (await conn.execute(CLAIM_INDEX_JOB, {"worker": worker, "lease_seconds": lease_seconds})).scalar()
+        if job_id is None:
+            return None
+        async with self.session() as session:
+            return await session.get(IndexJob, job_id)
+
+    async def update_index_job(self, job_id: uuid.UUID, worker: str, progress: dict, lease_seconds: int) -> bool:
+        async with self.engine.begin() as conn:
+            result = await conn.execute(UPDATE_INDEX_JOB, {"id": job_id, "worker": worker, "progress": progress,
+                                                           "lease_seconds": lease_seconds})
+            return result.rowcount > 0
+
+    async def finish_index_job(self, job_id: uuid.UUID, worker: str, error: str=None, retry_delay=60) -> IndexJob:
+        async with self.session() as session:
+            statement = select(IndexJob).\
+                where(IndexJob.id == job_id, IndexJob.state == "running", IndexJob.worker == worker).\
+                with_for_update()
+            job = (await session.exec(statement)).first()
+            if job is None:
+                return None
+
+            finish_job(job, error, retry_delay)
+            session.add(job)
+            await session.commit()
+            await session.refresh(job)
+            return job
+
+    async def find_active_index_job(self, runbook_set_id: uuid.UUID) -> IndexJob:
+        async with self.session() as session:
+            statement = select(IndexJob).where(IndexJob.runbook_set_id == runbook_set_id,
+                                               IndexJob.state.in_(["queued", "running"]))
+            results = await session.exec(statement)
+            return results.first()
+
+    async def find_latest_index_job(self, runbook_set_id: uuid.UUID) -> IndexJob:
+        async with self.session() as session:
+            statement = select(IndexJob).\
+                where(IndexJob.runbook_set_id == runbook_set_id).\
+                order_by(IndexJob.create_at.desc())
+            results = await session.exec(statement)
+            return results.first()
@@ -5,31 +5,122 @@ The response dspy signatures
 """
 
 import logging
+import re
+import uuid
+from datetime import datetime
 import dspy
+import litellm
 from models.chat import Record
 from prompts.templates import RESPONSE_NOTICES
 
 logger = logging.getLogger(__name__)
 
+field_header_pattern = re.compile(r"\[\[ ## (\w+) ## \]\]")
+
 class Response(dspy.Signature):
     """As an AI ACM assistant, you respond to the user's ACM query.
     """
 
     notices: str = dspy.InputField(desc="Notices for providing the response.")
     documents: list[str] = dspy.InputField(desc="The relevant documents.")
+    history_summary: str = dspy.InputField(desc="The summary of the earlier history records.", default="")
     history_records: list[Record] = dspy.InputField(desc="The previous history records.", default=[])
 
     query: str = dspy.InputField()
 
     response: str = dspy.OutputField()
 
-def respond(documents: list[str], query: str, history_records: list[Record], notices=RESPONSE_NOTICES):
+def respond(documents: list[str], query: str, history_records: list[Record], history_summary="",
+            notices=RESPONSE_NOTICES):
     resp = dspy.ChainOfThought(Response)
     result = resp(
         notices=notices,
         documents=documents,
         query=query,
+        history_summary=history_summary,
         history_records=history_records,
     )
     logger.debug(result)
     return result
+
+def stream_respond(documents: list[str], query: str, history_records: list[Record], history_summary="",
+                   notices=RESPONSE_NOTICES):
+    """
+    Stream the response, yield (field, delta) for the reasoning and response fields as the LM produces
+    them, and yield ("prediction", dspy.Prediction) with the parsed fields at last.
+    """
+    lm = dspy.settings.lm
+    signature = dspy.ChainOfThought(Response).extended_signature
+    adapter = dspy.settings.adapter or dspy.ChatAdapter()
+    messages = adapter.format(signature, demos=[], inputs={
+        "notices": notices,
+        "documents": documents,
+        "query": query,
+        "history_summary": history_summary,
+        "history_records": history_records,
+    })
+
+    completion = ""
+    streamed = {}
+    for delta in stream_lm(lm, messages):
+        completion = completion + delta
+        for field, value in split_fields(completion):
+            if field not in signature.output_fields:
+                continue
+
+            new_value = value[len(streamed.get(field, "")):]
+            if len(new_value) > 0:
+                streamed[field] = value
+                yield field, new_value
+
+    result = dspy.Prediction(**adapter.parse(signature, completion))
+    logger.debug(result)
+    yield "prediction", result
+
+def stream_lm(lm: dspy.LM, messages: list[dict]):
+    """
+    Stream the completion of the LM, dspy 2.5 does not stream, so the completion is requested the way
+    dspy.LM does, with its kwargs and the litellm cache that dspy configures (unless the LM is not
+    cached), and the dspy callbacks and the LM history are kept as for a dspy call.
+    """
+    call_id = uuid.uuid4().hex
+    callbacks = list(getattr(dspy.settings, "callbacks", None) or []) + list(getattr(lm, "callbacks", None) or [])
+    for callback in callbacks:
+        callback.on_lm_start(call_id=call_id, instance=lm, inputs={"messages": messages})
+
+    cache = {"no-cache": not lm.cache, "no-store": not lm.cache}
+    completion = ""
+    try:
+        chunks = litellm.completion(model=lm.model, messages=messages, stream=True, cache=cache,
+                                    num_retries=lm.num_retries, **lm.kwargs)
+        for chunk in chunks:
+            delta = chunk.choices[0].delta.content
+            if delta:
+                completion = completion + delta
+                yield delta
+    except Exception as e:
+        for callback in callbacks:
+            callback.on_lm_end(call_id=call_id, outputs=None, exception=e)
+        raise
+
+    for callback in callbacks:
+        callback.on_lm_end(call_id=call_id, outputs=[completion], exception=None)
+
+    # the api key is in lm.kwargs, it is not logged
+    entry = {"prompt": None, "messages": messages, "kwargs": {k: v for k, v in lm.kwargs.items() if k != "api_key"},
+             "outputs": [completion], "timestamp": datetime.now().isoformat(), "uuid": call_id,
+             "model": lm.model, "model_type": lm.model_type}
+    lm.history.append(entry)
+    if hasattr(lm, "update_global_history"):
+        lm.update_global_history(entry)
+
+def split_fields(completion: str) -> list[tuple[str, str]]:
+    # hold back a field header that is not completed yet
+    start = completion.rfind("[[")
+    if start != -1 and "]]" not in completion[start:]:
+        completion = completion[:start]
+    elif completion.endswith("["):
+        completion = completion[:-1]
+
+    parts = field_header_pattern.split(completion)
+    return [(parts[i], parts[i + 1].lstrip()) for i in range(1, len(parts) - 1, 2)]
@@ -6,9 +6,13 @@ The retriever dspy signatures
 
 import dspy
 import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from llama_index.core.schema import NodeWithScore
 from prompts.templates import CONVERTOR_NOTICES
 from pydantic import BaseModel
+from tools.embeddings.cache import normalize
 
 logger = logging.getLogger(__name__)
 
@@ -16,6 +20,30 @@ class RelevantNode(BaseModel):
     node: NodeWithScore
     score: int = 0
 
+class GradeCache:
+    """
+    A LRU cache of the relevance scores, keyed by the LM model, the normalized question and the node hash.
+    """
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[tuple[str, str, str], int] = OrderedDict()
+
+    def get(self, key: tuple[str, str, str]) -> int:
+        with self._lock:
+            score = self._entries.get(key)
+            if score is not None:
+                self._entries.move_to_end(key)
+            return score
+
+    def put(self, key: tuple[str, str, str], score: int):
+        with self._lock:
+            self._entries[key] = score
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
 class Convertor(dspy.Signature):
     """ Convert a query with contexts to a better version that is optimized for vector store retrieval.
     """
@@ -36,28 +64,85 @@ class Grader(dspy.Signature):
 
     score: int = dspy.OutputField(default=0)
 
+class ListGrader(dspy.Signature):
+    """Assess the relevance of each answer to the question.
+    Give a score from 0 to 10 for each answer. 10 means most relevant and 0 means least relevant.
+    """
+
+    question: str = dspy.InputField()
+    answers: list[str] = dspy.InputField()
+
+    scores: list[int] = dspy.OutputField(desc="The scores of the answers, one score per answer in the same order.")
+
 def convert_question(contexts: str, query: str, notices=CONVERTOR_NOTICES) -> str:
     convert = dspy.Predict(Convertor)
     response = convert(notices=notices, contexts=contexts, query=query)
     return response.new_query
 
-def grade_relevant_nodes(nodes: list[NodeWithScore], question: str, relevant_cutoff=5) -> list[RelevantNode]:
+def grade_relevant_nodes(nodes: list[NodeWithScore], question: str, relevant_cutoff=5,
+                         mode="parallel", max_workers=4, cache: GradeCache=None) -> list[RelevantNode]:
+    """
+    Grade the relevance of the nodes to the question, and give up the nodes below the relevant cutoff.
+      - mode: "parallel" grades the nodes one by one with at most max_workers concurrent LM calls,
+            "listwise" grades all of the nodes in a single LM call.
+      - cache: the scores are looked up in and saved to the cache if it is set.
+    """
+    if mode not in ("parallel", "listwise"):
+        raise ValueError(f"unknown grade mode {mode}, it should be parallel or listwise")
+
     if len(nodes) == 0:
         return []
 
+    lm = dspy.settings.lm
+    keys = [(lm.model, normalize(question), node.node.hash) for node in nodes]
+    scores = [cache.get(key) if cache is not None else None for key in keys]
+    ungraded = [i for i, score in enumerate(scores) if score is None]
+    logger.debug("grade nodes (total=%d, cached=%d, mode=%s)", len(nodes), len(nodes) - len(ungraded), mode)
+
+    if len(ungraded) > 0:
+        graded = None
+        if mode == "listwise":
+            graded = grade_listwise(question, [nodes[i].text for i in ungraded])
+        if graded is None:
+            graded = grade_parallel(lm, question, [nodes[i] for i in ungraded], max_workers)
+        for i, score in zip(ungraded, graded):
+            scores[i] = score
+            if cache is not None:
+                cache.put(keys[i], score)
+
     relevant_nodes = []
-    for node in nodes:
-        grade = dspy.ChainOfThought(Grader)
-        response = grade(question=question, answer=node.text)
-        score = response.score
-        logger.debug("%s %d %s",
-                        node.metadata["filename"], score, response.reasoning)
+    for node, score in zip(nodes, scores):
         if score < relevant_cutoff:
-            logger.info("give up the node: %0.3f %s, (%d<%d) reasoning=%s",
-                        node.score, node.metadata["filename"], score, relevant_cutoff, response.reasoning)
+            logger.info("give up the node: %0.3f %s, (%d<%d)",
+                        node.score or 0.0, node.metadata["filename"], score, relevant_cutoff)
             continue
 
         relevant_nodes.append(RelevantNode(node=node, score=score))
 
     relevant_nodes.sort(key=lambda n: n.score, reverse=True)
     return relevant_nodes
+
+def grade_parallel(lm: dspy.LM, question: str, nodes: list[NodeWithScore], max_workers: int) -> list[int]:
+    # the dspy settings are per thread, so the LM of the caller is passed into the workers
+    def grade_node(node: NodeWithScore) -> int:
+        with dspy.context(lm=lm):
+            grade = dspy.ChainOfThought(Grader)
+            response = grade(question=question, answer=node.text)
+        logger.debug("%s %d %s", node.metadata["filename"], response.score, response.reasoning)
+        return response.score
+
+    if len(nodes) == 1:
+        return [grade_node(nodes[0])]
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(nodes)), thread_name_prefix="grade") as executor:
+        return list(executor.map(grade_node, nodes))
+
+def grade_listwise(question: str, answers: list[str]) -> list[int]:
+    grade = dspy.ChainOfThought(ListGrader)
+    response = grade(question=question, answers=answers)
+    logger.debug("%s %s", response.scores, response.reasoning)
+    if len(response.scores) != len(answers):
+        logger.warning("listwise grade returned %d scores for %d answers, grade them one by one",
+                       len(response.scores), len(answers))
+        return None
+    return response.scores
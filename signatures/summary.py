@@ -0,0 +1,28 @@
+# coding: utf-8
+
+"""
+The summary dspy signatures
+"""
+
+import dspy
+import logging
+from models.chat import Record
+from prompts.templates import SUMMARY_NOTICES
+
+logger = logging.getLogger(__name__)
+
+class Summarizer(dspy.Signature):
+    """As an AI ACM assistant, you summarize the troubleshooting conversation with the user.
+    """
+
+    notices: str = dspy.InputField(desc="Notices for summarizing the conversation.")
+    summary: str = dspy.InputField(desc="The summary of the earlier history records.", default="")
+    history_records: list[Record] = dspy.InputField(desc="The history records to be summarized.")
+
+    new_summary: str = dspy.OutputField()
+
+def summarize(summary: str, history_records: list[Record], notices=SUMMARY_NOTICES) -> str:
+    summarizer = dspy.Predict(Summarizer)
+    result = summarizer(notices=notices, summary=summary, history_records=history_records)
+    logger.debug(result)
+    return result.new_summary
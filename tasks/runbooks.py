@@ -7,30 +7,101 @@ The task of indexing runbooks
 import logging
 import os
 import uuid
-from services.index import RAGService
+from typing import Callable, Iterable, Iterator
+from llama_index.core.schema import Document
+from services.index import RAGService, no_progress
 from services.storage import StorageService
+from tools.git import GitChanges, diff, ensure_commit
 from tools.loaders.markdown import load_runbooks
 from tools.loaders.adoc import load_acm_docs
 
 logger = logging.getLogger(__name__)
 
-def index(uid: uuid.UUID, repo_dir: str, version: str, rag_svc: RAGService, storage_svc: StorageService):
+def index(uid: uuid.UUID, repo_dir: str, version: str, rag_svc: RAGService, storage_svc: StorageService,
+          on_progress: Callable[[str, int], None]=None):
+    """
+    Index the version of the runbook set, a retried version starts over, the nodes written by the failed
+    attempt are deleted first, and the docs that are not changed since the previous indexed version are
+    carried forward rather than embedded again. The versions are the commits, so for the runbooks only
+    the changed files by git diff against the previous indexed version are read.
+      - on_progress: it is called with the progress counters, see models.docs.IndexProgress.
+    """
     rs = storage_svc.get_runbook_set(uid)
     if rs is None:
         logger.error("runbook set %s is not found", str(uid))
         return
 
-    rsv = storage_svc.add_runbook_set_version(runbook_set_id=uid, version=version)
+    if on_progress is None:
+        on_progress = no_progress
+
+    rsv = None
+    prev_rsv = None
+    for existing_rsv in storage_svc.list_runbook_set_versions(uid):
+        if existing_rsv.version == version:
+            rsv = existing_rsv
+        elif existing_rsv.state == "indexed":
+            prev_rsv = existing_rsv
 
     source = f"{os.path.basename(repo_dir)}-{version}"
-    docs = []
+    if rsv is None:
+        rsv = storage_svc.add_runbook_set_version(runbook_set_id=uid, version=version)
+    else:
+        # the version was attempted before, drop its partial nodes
+        rag_svc.delete_docs([source], vacuum=False)
+        rsv.state = "indexing"
+        storage_svc.update_runbook_set_version(rsv)
+
+    # the adoc docs include each other, so a changed file may change the other docs, they are always
+    # loaded in full and compared by their content
+    changes = None
+    if prev_rsv is not None and "rhacm-docs" not in repo_dir:
+        changes = detect_changes(repo_dir, prev_rsv.version, version)
+
     if "rhacm-docs" in repo_dir:
-        docs = load_acm_docs(adoc_dir=repo_dir, source=source)
+        docs = load_acm_docs(adoc_dir=repo_dir, source=source, on_progress=on_progress)
+    elif changes is not None:
+        docs = load_runbooks(md_dir=repo_dir, source=source,
+                             files=[os.path.join(repo_dir, f) for f in changes.changed_files()])
     else:
         docs = load_runbooks(md_dir=repo_dir, source=source)
+    docs = count_docs(docs, on_progress)
 
-    rag_svc.index_docs(docs=docs)
+    if prev_rsv is None:
+        rag_svc.index_docs(docs=docs, on_progress=on_progress)
+    elif changes is not None:
+        # only read the changed files, the docs of the other files are carried forward
+        changed_files = {os.path.join(repo_dir, f) for f in changes.changed_files() + changes.removed_files()}
+        rag_svc.reindex_docs(docs=docs, prev_source=f"{os.path.basename(repo_dir)}-{prev_rsv.version}",
+                             on_progress=on_progress, source=source, changed_files=changed_files)
+    else:
+        # only embed the changed docs since the previous indexed version
+        rag_svc.reindex_docs(docs=docs, prev_source=f"{os.path.basename(repo_dir)}-{prev_rsv.version}",
+                             on_progress=on_progress)
 
     rsv.state = "indexed"
     storage_svc.update_runbook_set_version(rsv)
     logger.info("runbooks %s (%s) were indexed", source, version)
+
+def detect_changes(repo_dir: str, prev_version: str, version: str) -> GitChanges:
+    # the repo is cloned shallowly, so the history is deepened until the previous version is reachable,
+    # the changes are None if it is not, and the docs are loaded in full
+    if not ensure_commit(cwd=repo_dir, commit=prev_version):
+        return None
+
+    changes = diff(cwd=repo_dir, base=prev_version, head=version)
+    if changes is not None:
+        logger.info("runbooks %s..%s changed (added=%d, modified=%d, deleted=%d, renamed=%d)",
+                    prev_version, version, len(changes.added), len(changes.modified), len(changes.deleted),
+                    len(changes.renamed))
+    return changes
+
+def mark_failed(uid: uuid.UUID, version: str, storage_svc: StorageService):
+    for rsv in storage_svc.list_runbook_set_versions(uid):
+        if rsv.version == version:
+            rsv.state = "failed"
+            storage_svc.update_runbook_set_version(rsv)
+
+def count_docs(docs: Iterable[Document], on_progress: Callable[[str, int], None]) -> Iterator[Document]:
+    for doc in docs:
+        on_progress("docs_read", 1)
+        yield doc
@@ -0,0 +1,149 @@
+# coding: utf-8
+
+# pylint: disable=missing-class-docstring
+
+"""
+The worker of the index jobs
+
+The server queues an index job per runbook set version in Postgres, the workers claim the jobs with
+SKIP LOCKED, so any number of workers can run on the hosts that share DOC_DIR with the server. A claimed
+job is leased to its worker, the lease is extended by a heartbeat while it runs, and the job of a crashed
+worker is claimed again once its lease is expired. A failed job is retried with a backoff until it is
+out of attempts.
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+from dotenv import load_dotenv
+from llama_index.core import Settings
+from llama_index.core.node_parser import SentenceSplitter
+from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+from models.docs import IndexProgress
+from services.index import RAGService
+from services.storage import IndexJob, StorageService
+from tasks.runbooks import index, mark_failed
+from tools.embeddings.huggingface import BGE
+
+logger = logging.getLogger(__name__)
+
+class JobCancelledError(RuntimeError):
+    pass
+
+class JobProgress:
+    """
+    The progress counters of a running job, they are incremented from the stage threads of the index
+    pipeline. A heartbeat thread saves them and extends the lease every heartbeat_interval seconds, so
+    the lease is kept by the steps that make no progress, e.g. deleting the partial nodes of a retry.
+    """
+
+    def __init__(self, storage_svc: StorageService, job: IndexJob, worker: str, lease_seconds: int,
+                 heartbeat_interval=2.0):
+        self.storage_svc = storage_svc
+        self.job = job
+        self.worker = worker
+        self.lease_seconds = lease_seconds
+        self.heartbeat_interval = min(heartbeat_interval, lease_seconds / 3)
+
+        self._lock = threading.Lock()
+        self._progress = IndexProgress()
+        self._stopped = threading.Event()
+        self._cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._heartbeat, name="index-heartbeat", daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *_):
+        self._stopped.set()
+        self._thread.join()
+        self.flush()
+
+    def incr(self, name: str, n: int):
+        if self._cancelled.is_set():
+            raise JobCancelledError(f"index job {str(self.job.id)} is not running on {self.worker} anymore")
+        with self._lock:
+            setattr(self._progress, name, getattr(self._progress, name) + n)
+
+    def flush(self) -> bool:
+        with self._lock:
+            progress = self._progress.model_dump()
+        return self.storage_svc.update_index_job(self.job.id, self.worker, progress, self.lease_seconds)
+
+    def _heartbeat(self):
+        while not self._stopped.wait(self.heartbeat_interval):
+            try:
+                if not self.flush():
+                    # the job is deleted or claimed by another worker, the index stops at the next progress
+                    self._cancelled.set()
+                    return
+            except Exception as e: # pylint: disable=broad-exception-caught
+                # the lease is extended by the next heartbeat
+                logger.warning("failed to extend the lease of index job %s, %s", str(self.job.id), e)
+
+def run_job(job: IndexJob, worker: str, rag_svc: RAGService, storage_svc: StorageService,
+            lease_seconds: int, retry_delay: int):
+    start_time = time.time()
+    logger.info("index job %s (%s, attempt %d/%d) is running on %s",
+                str(job.id), job.version, job.attempts, job.max_attempts, worker)
+
+    try:
+        with JobProgress(storage_svc, job, worker, lease_seconds) as progress:
+            index(job.runbook_set_id, job.repo_dir, job.version, rag_svc, storage_svc, on_progress=progress.incr)
+    except JobCancelledError as e:
+        logger.warning("%s, time used %.3fs", e, (time.time() - start_time))
+        return
+    except Exception as e: # pylint: disable=broad-exception-caught
+        logger.exception("index job %s (%s) failed, time used %.3fs", str(job.id), job.version,
+                         (time.time() - start_time))
+        mark_failed(job.runbook_set_id, job.version, storage_svc)
+        storage_svc.finish_index_job(job.id, worker, error=str(e), retry_delay=retry_delay)
+        return
+
+    storage_svc.finish_index_job(job.id, worker)
+    logger.info("index job %s (%s) is done, time used %.3fs", str(job.id), job.version, (time.time() - start_time))
+
+def run(rag_svc: RAGService, storage_svc: StorageService, worker: str, lease_seconds: int, retry_delay: int,
+        poll_interval: float):
+    logger.info("index worker %s is started", worker)
+    while True:
+        try:
+            job = storage_svc.claim_index_job(worker, lease_seconds)
+            if job is not None:
+                run_job(job, worker, rag_svc, storage_svc, lease_seconds, retry_delay)
+                continue
+        except Exception: # pylint: disable=broad-exception-caught
+            # e.g. the database is restarted, keep polling, a job that is not finished is claimed again
+            # when its lease is expired
+            logger.exception("index worker %s failed to run the jobs, retry in %.1fs", worker, poll_interval)
+        time.sleep(poll_interval)
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+
+    # the same embedding settings as the server, so the nodes are embedded by the same model
+    Settings.llm = None
+    Settings.embed_model = HuggingFaceEmbedding(model_name=BGE.name,
+                                               embed_batch_size=int(os.getenv("EMBED_BATCH_SIZE", "32")))
+    Settings.transformations = [SentenceSplitter(chunk_size=BGE.chunk_size, chunk_overlap=200)]
+
+    run(
+        rag_svc=RAGService(
+            db_url=os.getenv("DATABASE_URL"),
+            embed_dim=BGE.dims,
+            hnsw_m=int(os.getenv("HNSW_M", "16")),
+            hnsw_ef_construction=int(os.getenv("HNSW_EF_CONSTRUCTION", "64")),
+            index_batch_size=int(os.getenv("INDEX_BATCH_SIZE", "256")),
+            index_queue_size=int(os.getenv("INDEX_QUEUE_SIZE", "4")),
+            hybrid_search=os.getenv("HYBRID_SEARCH", "false").lower() == "true",
+        ),
+        storage_svc=StorageService(db_url=os.getenv("DATABASE_URL")),
+        worker=os.getenv("INDEX_WORKER_NAME", f"{socket.gethostname()}-{os.getpid()}"),
+        lease_seconds=int(os.getenv("INDEX_JOB_LEASE_SECONDS", "300")),
+        retry_delay=int(os.getenv("INDEX_JOB_RETRY_DELAY", "60")),
+        poll_interval=float(os.getenv("INDEX_JOB_POLL_INTERVAL", "5")),
+    )
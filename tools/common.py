@@ -4,6 +4,7 @@
 The common helper functions
 """
 
+import functools
 import os
 import re
 import subprocess
@@ -33,10 +34,27 @@ def replace_start(s: str, old_value: str, new_value: str):
 def replace_end(s: str, old_value: str, new_value: str):
     return re.sub(f'{old_value}$', new_value, s)
 
-def count_tokens(text, encoding_name='cl100k_base'):
-    encoding = tiktoken.get_encoding(encoding_name)
+@functools.lru_cache(maxsize=32)
+def get_encoding(model=None, encoding_name='cl100k_base') -> tiktoken.Encoding:
+    if model is not None:
+        # the litellm model name may have a provider prefix, e.g. openai/gpt-4o
+        try:
+            return tiktoken.encoding_for_model(model.split('/')[-1])
+        except KeyError:
+            pass
+    return tiktoken.get_encoding(encoding_name)
+
+def count_tokens(text, encoding_name='cl100k_base', model=None):
+    encoding = get_encoding(model=model, encoding_name=encoding_name)
     return len(encoding.encode(text))
 
+def truncate_tokens(text, max_tokens, encoding_name='cl100k_base', model=None):
+    encoding = get_encoding(model=model, encoding_name=encoding_name)
+    tokens = encoding.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
+
 def run_commands(cmds, cwd, timeout):
     try:
         result = subprocess.run(
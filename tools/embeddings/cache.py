@@ -0,0 +1,116 @@
+# coding: utf-8
+
+# pylint: disable=missing-class-docstring
+
+"""
+The cache of the query embeddings
+"""
+
+import logging
+import os
+import pickle
+import re
+import threading
+from array import array
+from collections import OrderedDict
+from llama_index.core import Settings
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from pydantic import BaseModel
+
+logger = logging.getLogger(__name__)
+
+# the version of the keys in the cache file, the files of the other versions are not loaded
+CACHE_VERSION = 2
+
+class EmbeddingCacheMetrics(BaseModel):
+    entries: int = 0
+    hits: int = 0
+    misses: int = 0
+
+class QueryEmbeddingCache:
+    """
+    A LRU cache in front of the embed model for the query embeddings, the entries are keyed by the
+    embed model name and the normalized query, and the normalized query is what is embedded, so the
+    queries that share an entry get the same embedding regardless of which one comes first. The
+    embeddings are kept as float32 arrays, so the memory is bounded by max_entries * embed_dim * 4 bytes.
+      - path: if it is set, the entries are loaded from the file on start and saved to it by save().
+    """
+
+    def __init__(self, embed_model: BaseEmbedding=None, max_entries=4096, path: str=None):
+        self._embed_model = embed_model
+        self.max_entries = max_entries
+        self.path = path
+
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[tuple[str, str], array] = OrderedDict()
+        self._metrics = EmbeddingCacheMetrics()
+        self.load()
+
+    @property
+    def embed_model(self) -> BaseEmbedding:
+        return self._embed_model if self._embed_model is not None else Settings.embed_model
+
+    def get_query_embedding(self, query: str) -> list[float]:
+        embed_model = self.embed_model
+        normalized = normalize(query)
+        key = (embed_model.model_name, normalized)
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is not None:
+                self._entries.move_to_end(key)
+                self._metrics.hits = self._metrics.hits + 1
+                return embedding.tolist()
+            self._metrics.misses = self._metrics.misses + 1
+
+        embedding = embed_model.get_query_embedding(normalized)
+        with self._lock:
+            self._entries[key] = array("f", embedding)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return embedding
+
+    def metrics(self) -> EmbeddingCacheMetrics:
+        with self._lock:
+            metrics = self._metrics.model_copy()
+            metrics.entries = len(self._entries)
+        return metrics
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, "rb") as f:
+                content = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            logger.warning("failed to load the query embedding cache from %s, %s", self.path, e)
+            return
+
+        if not isinstance(content, tuple) or content[0] != CACHE_VERSION:
+            logger.warning("the query embedding cache in %s is of another version, it is not loaded", self.path)
+            return
+        entries = content[1]
+
+        with self._lock:
+            for key, embedding in list(entries.items())[-self.max_entries:]:
+                self._entries[key] = embedding
+        logger.info("query embedding cache (entries=%d) is loaded from %s", len(self._entries), self.path)
+
+    def save(self):
+        if self.path is None:
+            return
+
+        with self._lock:
+            entries = OrderedDict(self._entries)
+
+        # write to a temporary file first, so that a crash does not leave a broken cache file
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((CACHE_VERSION, entries), f)
+        os.replace(tmp_path, self.path)
+        logger.info("query embedding cache (entries=%d) is saved to %s", len(entries), self.path)
+
+def normalize(query: str) -> str:
+    # only the whitespace is normalized, the embed model is cased
+    return re.sub(r"\s+", " ", query.strip())
@@ -0,0 +1,61 @@
+# coding: utf-8
+
+# pylint: disable=missing-class-docstring
+
+"""
+The executor to run the blocking functions off the event loop
+"""
+
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+class ExecutorFullError(RuntimeError):
+    pass
+
+class BoundedExecutor:
+    """
+    A thread pool executor with a bounded backlog, at most max_workers functions run at the same time
+    and at most max_queued functions wait for a worker, the functions beyond that are rejected with
+    an ExecutorFullError.
+    """
+
+    def __init__(self, max_workers: int, max_queued: int, name: str):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    @property
+    def pending(self) -> int:
+        with self._lock:
+            return self._pending
+
+    async def run(self, func, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(func, *args, **kwargs))
+
+    def submit(self, func, *args, **kwargs) -> Future:
+        with self._lock:
+            if self._pending >= self.max_workers + self.max_queued:
+                raise ExecutorFullError(f"too many pending tasks ({self._pending})")
+            self._pending = self._pending + 1
+
+        # the slot is released when the function finishes, even if the caller is cancelled, and the
+        # function runs in a copy of the caller's context, e.g. the request id
+        try:
+            future = self._executor.submit(contextvars.copy_context().run, functools.partial(func, *args, **kwargs))
+        except RuntimeError:
+            self._release(None)
+            raise
+        future.add_done_callback(self._release)
+        return future
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+    def _release(self, _):
+        with self._lock:
+            self._pending = self._pending - 1
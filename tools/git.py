@@ -1,15 +1,35 @@
 # coding: utf-8
 
+# pylint: disable=missing-class-docstring
+
 """
 The git commands
 """
 
 import logging
 from urllib.parse import urlparse
+from pydantic import BaseModel
 from tools.common import run_commands
 
 logger = logging.getLogger(__name__)
 
+class GitChanges(BaseModel):
+    """
+    The changed files between two commits, the paths are relative to the repo dir.
+    """
+    added: list[str] = []
+    modified: list[str] = []
+    deleted: list[str] = []
+    renamed: list[tuple[str, str]] = []
+
+    def changed_files(self) -> list[str]:
+        # the files to read in the new commit
+        return self.added + self.modified + [new for _, new in self.renamed]
+
+    def removed_files(self) -> list[str]:
+        # the files that are gone from the old commit
+        return self.deleted + [old for old, _ in self.renamed]
+
 def parse_repo(repo: str):
     url_result = urlparse(repo)
     dot_git_index = url_result.path.index(".git")
@@ -26,3 +46,62 @@ def pull(cwd: str, timeout=120):
 def fetch_head_commit(cwd: str, timeout=120):
     cmds = ["git", "--no-pager", "log", "--pretty=format:%h", "-n1"]
     return run_commands(cmds=cmds, cwd=cwd, timeout=timeout)
+
+def has_commit(cwd: str, commit: str, timeout=120) -> bool:
+    cmds = ["git", "rev-parse", "--verify", "--quiet", f"{commit}^{{commit}}"]
+    return run_commands(cmds=cmds, cwd=cwd, timeout=timeout).return_code == 0
+
+def ensure_commit(cwd: str, commit: str, deepen=50, max_depth=1000, timeout=120) -> bool:
+    """
+    Make sure the commit is in the local history, the repo is cloned with --depth=1 and a commit that
+    is older than the shallow boundary is missing, so the history is deepened by deepen commits at a
+    time, until the commit is found, the repo is not shallow anymore or max_depth is reached.
+    """
+    depth = 0
+    while not has_commit(cwd, commit, timeout):
+        result = run_commands(cmds=["git", "rev-parse", "--is-shallow-repository"], cwd=cwd, timeout=timeout)
+        if result.stdout.strip() != "true" or depth >= max_depth:
+            logger.warning("commit %s is not found in %s (deepened=%d)", commit, cwd, depth)
+            return False
+
+        result = run_commands(cmds=["git", "fetch", f"--deepen={deepen}"], cwd=cwd, timeout=timeout)
+        if result.return_code != 0:
+            logger.warning("failed to deepen %s, %s", cwd, result.stderr)
+            return False
+        depth = depth + deepen
+    return True
+
+def diff(cwd: str, base: str, head="HEAD", timeout=120) -> GitChanges:
+    """
+    The changed files between base and head, the renames are detected, and a copied or type changed
+    file is taken as added or modified. It is None if the diff fails.
+    """
+    cmds = ["git", "--no-pager", "diff", "--name-status", "-z", "-M", "--no-color", base, head]
+    result = run_commands(cmds=cmds, cwd=cwd, timeout=timeout)
+    if result.return_code != 0:
+        logger.warning("failed to diff %s..%s in %s, %s", base, head, cwd, result.stderr)
+        return None
+
+    changes = GitChanges()
+    fields = result.stdout.split("\0")
+    i = 0
+    while i < len(fields) and fields[i] != "":
+        status = fields[i][0]
+        if status in ("R", "C"):
+            old, new = fields[i + 1], fields[i + 2]
+            if status == "R":
+                changes.renamed.append((old, new))
+            else:
+                changes.added.append(new)
+            i = i + 3
+            continue
+
+        path = fields[i + 1]
+        if status == "A":
+            changes.added.append(path)
+        elif status == "D":
+            changes.deleted.append(path)
+        else:
+            changes.modified.append(path)
+        i = i + 2
+    return changes
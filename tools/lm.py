@@ -0,0 +1,123 @@
+# coding: utf-8
+
+# pylint: disable=missing-class-docstring
+
+"""
+The registry of the LM clients
+"""
+
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+import dspy
+import httpx
+import litellm
+from pydantic import BaseModel
+from models.contexts import LLMConfig
+
+logger = logging.getLogger(__name__)
+
+class LMRegistryMetrics(BaseModel):
+    entries: int = 0
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+class LMRegistry:
+    """
+    A registry of the LM clients, the clients are keyed by (model, api_base, the hash of api_key) and
+    reused across the requests. A client is scoped to a request with context(), rather than set globally,
+    so the concurrent requests with different LLM configs do not race on the global dspy settings.
+    The LM holds no HTTP connections, the calls go through litellm, so the registry gives litellm one
+    pooled HTTP client, and the connections are kept alive across the requests and the configs.
+    dspy appends every call to the LM history, the history is trimmed when a context exits, so a busy
+    client does not grow until it is evicted.
+      - idle_timeout: the clients that are not used for this many seconds are evicted.
+      - max_entries: the least recently used clients beyond this are evicted.
+      - max_history: the most recent calls that are kept in the history of a client.
+      - max_connections: the maximum HTTP connections of the shared client.
+      - keepalive_expiry: the idle HTTP connections are closed after this many seconds.
+    """
+
+    def __init__(self, idle_timeout=600, max_entries=32, max_history=16, max_connections=64,
+                 keepalive_expiry=60.0):
+        self.idle_timeout = idle_timeout
+        self.max_entries = max_entries
+        self.max_history = max_history
+
+        self.http_client = httpx.Client(limits=httpx.Limits(max_connections=max_connections,
+                                                            max_keepalive_connections=max_connections,
+                                                            keepalive_expiry=keepalive_expiry))
+        # litellm builds its provider clients (e.g. the openai ones) on this session
+        litellm.client_session = self.http_client
+
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[tuple[str, str, str], tuple[dspy.LM, float]] = OrderedDict()
+        self._metrics = LMRegistryMetrics()
+
+    def get(self, mcfg: LLMConfig) -> dspy.LM:
+        key = (mcfg.model, mcfg.api_base, hash_key(mcfg.api_key))
+        now = time.monotonic()
+        with self._lock:
+            self._evict(now)
+            entry = self._entries.get(key)
+            if entry is not None:
+                lm = entry[0]
+                self._metrics.hits = self._metrics.hits + 1
+            else:
+                lm = dspy.LM(model=mcfg.model, api_base=mcfg.api_base, api_key=mcfg.api_key)
+                self._metrics.misses = self._metrics.misses + 1
+                logger.info("LM client (model=%s, api_base=%s) is created", mcfg.model, mcfg.api_base)
+            self._entries[key] = (lm, now)
+            self._entries.move_to_end(key)
+            return lm
+
+    @contextmanager
+    def context(self, mcfg: LLMConfig):
+        """
+        Use the LM client of the config in the current thread within the context.
+        """
+        lm = self.get(mcfg)
+        try:
+            with dspy.context(lm=lm):
+                yield lm
+        finally:
+            self._trim_history(lm)
+
+    def close(self):
+        if litellm.client_session is self.http_client:
+            litellm.client_session = None
+        self.http_client.close()
+
+    def metrics(self) -> LMRegistryMetrics:
+        with self._lock:
+            self._evict(time.monotonic())
+            metrics = self._metrics.model_copy()
+            metrics.entries = len(self._entries)
+        return metrics
+
+    def _trim_history(self, lm: dspy.LM):
+        # the concurrent requests append to the same history, the trims are serialized so the entries are
+        # not deleted twice
+        with self._lock:
+            excess = len(lm.history) - self.max_history
+            if excess > 0:
+                del lm.history[:excess]
+
+    def _evict(self, now: float):
+        # the entries are ordered by the last used time
+        while len(self._entries) > 0:
+            key, (_, last_used) = next(iter(self._entries.items()))
+            if len(self._entries) <= self.max_entries and now - last_used <= self.idle_timeout:
+                break
+            self._entries.popitem(last=False)
+            self._metrics.evictions = self._metrics.evictions + 1
+            logger.info("LM client (model=%s, api_base=%s) is evicted", key[0], key[1])
+
+def hash_key(api_key: str) -> str:
+    if api_key is None:
+        return ""
+    return hashlib.sha256(api_key.encode()).hexdigest()
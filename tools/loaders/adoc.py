@@ -6,10 +6,15 @@ Load adoc files
 
 import os
 import logging
+import hashlib
 import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator
 from llama_index.core.schema import Document
 from tools.common import run_commands
-from tools.loaders.helper import list_files, to_docs
+from tools.loaders.helper import iter_docs, list_files
 
 acm_docs_attrs = {
   "aap": "Red Hat Ansible Automation Platform",
@@ -52,26 +57,78 @@ def convert_adoc_to_md(adoc_file, output_file):
     if convert_result.return_code != 0:
         raise RuntimeError(f"failed to convert adoc docs, {convert_result.stderr}")
 
+def convert_adoc_to_md_cached(adoc_file, output_file, cache_dir) -> tuple[str, bool, float]:
+    """
+    Convert the adoc file with the conversion cache, the converted markdown is cached by the md5 of
+    the adoc file, so an unchanged file is never converted again. Return the cached file, whether the
+    cache is hit and the time used.
+    """
+    start_time = time.time()
+    with open(adoc_file, "rb") as f:
+        adoc_hash = hashlib.md5(f.read()).hexdigest()
+
+    cached_file = os.path.join(cache_dir, f"{adoc_hash}.md")
+    hit = os.path.exists(cached_file)
+    if not hit:
+        # convert to a temporary file first, so that a failed conversion is never cached
+        tmp_file = f"{cached_file}.{uuid.uuid4().hex}.tmp"
+        convert_adoc_to_md(adoc_file, tmp_file)
+        os.replace(tmp_file, cached_file)
+
+    shutil.copyfile(cached_file, output_file)
+    elapsed = time.time() - start_time
+    logger.debug("convert adoc %s (cached=%s), time used %.3fs", adoc_file, hit, elapsed)
+    return cached_file, hit, elapsed
+
 def mk_output_dir(output_dir):
     if os.path.exists(output_dir):
         shutil.rmtree(output_dir)
     os.mkdir(output_dir)
 
-def load_acm_docs(adoc_dir: str, source: str, exclude_list=None) -> list[Document]:
+def load_acm_docs(adoc_dir: str, source: str, exclude_list=None, workers=None,
+                  on_progress: Callable[[str, int], None]=None) -> Iterator[Document]:
+    """
+    Load the acm docs lazily, the adoc files are converted when the docs are first consumed, since the
+    repetitive docs are only known after all of the files are converted, then the markdown files are
+    read one by one as the docs are consumed.
+      - on_progress: it is called with ("files_converted", 1) as each adoc file is converted.
+    """
     if exclude_list is None:
         exclude_list = ["apis", "api", "README.adoc", "SECURITY.adoc", "EXTERNAL_CONTRIBUTING.adoc",
                         ".asciidoctorconfig.adoc", "common-attributes.adoc", "main.adoc", "master.adoc"]
 
     parent_dir = os.path.dirname(adoc_dir)
     md_dir = os.path.join(parent_dir, f"{os.path.basename(adoc_dir)}-md")
+    cache_dir = os.path.join(parent_dir, f"{os.path.basename(adoc_dir)}-md-cache")
 
     # prepare markdown output dir
     mk_output_dir(md_dir)
+    os.makedirs(cache_dir, exist_ok=True)
 
     # convert adoc to markdown
-    for f in list_files(adoc_dir, exclude_list, ".adoc"):
-        logger.info("convert adoc %s", f)
-        convert_adoc_to_md(f, os.path.join(md_dir, f.replace(adoc_dir, "").replace("/", "_")[1:]) + ".md")
+    start_time = time.time()
+    adoc_files = list_files(adoc_dir, exclude_list, ".adoc")
+    with ThreadPoolExecutor(max_workers=workers if workers else os.cpu_count()) as executor:
+        futures = []
+        for f in adoc_files:
+            output_file = os.path.join(md_dir, f.replace(adoc_dir, "").replace("/", "_")[1:]) + ".md"
+            futures.append(executor.submit(convert_adoc_to_md_cached, f, output_file, cache_dir))
+        results = []
+        for future in futures:
+            results.append(future.result())
+            if on_progress is not None:
+                on_progress("files_converted", 1)
+
+    hits = sum(1 for _, hit, _ in results if hit)
+    logger.info("adoc docs (total=%d, cached=%d, converted=%d) are converted, time used %.3fs (convert %.3fs)",
+                len(results), hits, len(results) - hits, (time.time() - start_time),
+                sum(elapsed for _, hit, elapsed in results if not hit))
+
+    # only keep the cached files of the current docs
+    cached_files = {cached_file for cached_file, _, _ in results}
+    for f in os.listdir(cache_dir):
+        if os.path.join(cache_dir, f) not in cached_files:
+            os.remove(os.path.join(cache_dir, f))
 
     mce_troubleshooting_docs = set()
     acm_troubleshooting_docs = set()
@@ -103,8 +160,6 @@ def load_acm_docs(adoc_dir: str, source: str, exclude_list=None) -> list[Documen
         if name in acm_troubleshooting_docs:
             acm_troubleshooting_docs.remove(name)
 
-    docs = []
-    docs.extend(to_docs(mce_troubleshooting_docs, source, acm_docs_attrs))
-    docs.extend(to_docs(acm_troubleshooting_docs, source, acm_docs_attrs))
-    docs.extend(to_docs(acm_docs, source, acm_docs_attrs, True))
-    return docs
+    yield from iter_docs(mce_troubleshooting_docs, source, acm_docs_attrs)
+    yield from iter_docs(acm_troubleshooting_docs, source, acm_docs_attrs)
+    yield from iter_docs(acm_docs, source, acm_docs_attrs, True)
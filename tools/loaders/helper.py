@@ -28,8 +28,23 @@ def list_files(start_path, exclude_list, suffix):
 
     return file_list
 
-def to_docs(files, source, envs=None, partition=False, chunk_size=2048):
-    docs = []
+def filter_files(files, exclude_list, suffix):
+    """
+    Keep the existing files with the same rules as list_files, for the given files rather than a walk.
+    """
+    file_list = []
+    for f in files:
+        if os.path.basename(os.path.dirname(f)) in exclude_list:
+            continue
+        if f.endswith(suffix) and os.path.basename(f) not in exclude_list and os.path.isfile(f):
+            file_list.append(f)
+
+    return file_list
+
+def iter_docs(files, source, envs=None, partition=False, chunk_size=2048):
+    """
+    Read the files into docs lazily, one file is read only when its docs are consumed.
+    """
     for f in files:
         doc = FlatReader().load_data(Path(f))[0]
 
@@ -41,7 +56,7 @@ def to_docs(files, source, envs=None, partition=False, chunk_size=2048):
             # TODO need a better way to handle this
             if partition:
                 logger.warning("partition the large docs %s (tokens=%d)", f, tokens)
-                docs.extend(do_partition(f, source, envs))
+                yield from do_partition(f, source, envs)
                 continue
 
             logger.warning("ignore the large docs %s (tokens=%d)", f, tokens)
@@ -54,8 +69,7 @@ def to_docs(files, source, envs=None, partition=False, chunk_size=2048):
             "source": source,
         }
 
-        docs.append(doc)
-    return docs
+        yield doc
 
 def do_partition(f, source, doc_envs=None):
     docs = MarkdownReader().load_data(Path(f))
@@ -4,11 +4,17 @@
 Load markdown files
 """
 
+from typing import Iterator
 from llama_index.core.schema import Document
-from tools.loaders.helper import list_files, to_docs
+from tools.loaders.helper import filter_files, iter_docs, list_files
 
-def load_runbooks(md_dir: str, source: str, exclude_list=None) -> list[Document]:
+def load_runbooks(md_dir: str, source: str, exclude_list=None, files: list[str]=None) -> Iterator[Document]:
+    """
+    Load the runbooks under md_dir, or only the given files (e.g. the changed files) if files is set.
+    """
     if exclude_list is None:
         exclude_list = ["README.md", "SECURITY.md", "GUIDELINE.md", "index.md"]
 
-    return to_docs(list_files(md_dir, exclude_list, ".md"), source)
+    if files is not None:
+        return iter_docs(filter_files(files, exclude_list, ".md"), source)
+    return iter_docs(list_files(md_dir, exclude_list, ".md"), source)
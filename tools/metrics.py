@@ -0,0 +1,123 @@
+# coding: utf-8
+
+# pylint: disable=missing-class-docstring
+
+"""
+The metrics and the trace spans of the pipeline stages
+"""
+
+import bisect
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable
+from opentelemetry import trace
+
+logger = logging.getLogger(__name__)
+
+# the request id is shared by the spans of a request, it is copied into the executor threads with the context
+request_id = contextvars.ContextVar("request_id", default="")
+
+# the spans are no-op unless an OpenTelemetry SDK tracer provider is configured
+tracer = trace.get_tracer("acm-troubleshooter")
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum = self.sum + value
+        self.count = self.count + 1
+
+class MetricsRegistry:
+    """
+    The in-process metrics, the stage latency histograms, the counters and the gauges that are
+    collected from the services when the metrics are rendered.
+    """
+
+    def __init__(self, prefix="acm_troubleshooter"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._histograms: dict[str, Histogram] = {}
+        self._counters: dict[str, int] = {}
+        self._collectors: dict[str, Callable[[], dict[str, float]]] = {}
+        self._observers: list[Callable[[str, float], None]] = []
+
+    def observe(self, stage: str, seconds: float):
+        with self._lock:
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                histogram = self._histograms[stage] = Histogram()
+            histogram.observe(seconds)
+        for observer in self._observers:
+            observer(stage, seconds)
+
+    def add_observer(self, observer: Callable[[str, float], None]):
+        # the raw stage durations are passed to the observer, e.g. the benchmark computes the percentiles
+        self._observers.append(observer)
+
+    def incr(self, name: str, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def register_collector(self, name: str, collect: Callable[[], dict[str, float]]):
+        self._collectors[name] = collect
+
+    def render(self) -> str:
+        """
+        Render the metrics in the Prometheus text format.
+        """
+        lines = []
+        with self._lock:
+            name = f"{self.prefix}_stage_duration_seconds"
+            lines.append(f"# TYPE {name} histogram")
+            for stage, histogram in sorted(self._histograms.items()):
+                cumulative = 0
+                for bucket, count in zip(histogram.buckets, histogram.counts):
+                    cumulative = cumulative + count
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="{bucket}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+                lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.sum}')
+                lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+
+            for counter, value in sorted(self._counters.items()):
+                lines.append(f"# TYPE {self.prefix}_{counter}_total counter")
+                lines.append(f"{self.prefix}_{counter}_total {value}")
+
+        for collector, collect in sorted(self._collectors.items()):
+            try:
+                values = collect()
+            except Exception as e: # pylint: disable=broad-exception-caught
+                logger.warning("failed to collect the metrics of %s, %s", collector, e)
+                continue
+            for key, value in values.items():
+                lines.append(f"# TYPE {self.prefix}_{collector}_{key} gauge")
+                lines.append(f"{self.prefix}_{collector}_{key} {float(value)}")
+        return "\n".join(lines) + "\n"
+
+registry = MetricsRegistry()
+
+@contextmanager
+def span(stage: str):
+    """
+    Measure the stage into the stage histogram, and trace it as a span with the request id.
+    """
+    start_time = time.perf_counter()
+    with tracer.start_as_current_span(stage, attributes={"request_id": request_id.get()}):
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start_time
+            registry.observe(stage, elapsed)
+            logger.debug("stage %s (request_id=%s), time used %.3fs", stage, request_id.get(), elapsed)
+
+def incr(name: str, value=1):
+    registry.incr(name, value)
@@ -0,0 +1,69 @@
+# coding: utf-8
+
+"""
+The helper functions to build the streaming pipelines
+"""
+
+import queue
+import threading
+from typing import Callable, Iterable, Iterator
+
+_END = object()
+
+class _Failure:
+    def __init__(self, error: Exception):
+        self.error = error
+
+def stage(items: Iterable, func: Callable=None, maxsize=4, name="stage") -> Iterator:
+    """
+    Run a pipeline stage on a background thread, the items are taken from the upstream iterable, mapped
+    by func (if it is set) and put into a bounded queue, so the stage runs ahead of its consumer by at
+    most maxsize items. The error of the stage is raised to the consumer, and the stage stops once the
+    consumer is closed.
+    """
+    q = queue.Queue(maxsize=maxsize)
+    stopped = threading.Event()
+
+    def put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def run():
+        try:
+            for item in items:
+                if func is not None:
+                    item = func(item)
+                if not put(item):
+                    return
+        except Exception as e: # pylint: disable=broad-exception-caught
+            put(_Failure(e))
+            return
+        put(_END)
+
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = q.get()
+            if item is _END:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stopped.set()
+
+def batched(items: Iterable, size: int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if len(batch) > 0:
+        yield batch
@@ -7,6 +7,7 @@ The UI of ACM troubleshooter service
 """
 
 import os
+import json
 import logging
 import requests
 import sys
@@ -33,6 +34,20 @@ def send_req(chat_req: Request) -> Response:
 
     return None, f"failed to response, err=({http_resp.status_code}, {http_resp.content})"
 
+def stream_req(chat_req: Request):
+    with requests.post(f"{server_url}/chat/stream", data=chat_req.model_dump_json(), stream=True,
+                       timeout=300) as http_resp:
+        if http_resp.status_code != 200:
+            yield "error", {"detail": f"failed to response, err=({http_resp.status_code}, {http_resp.content})"}
+            return
+
+        event = None
+        for line in http_resp.iter_lines(decode_unicode=True):
+            if line.startswith("event:"):
+                event = line[len("event:"):].strip()
+            elif line.startswith("data:"):
+                yield event, json.loads(line[len("data:"):].strip())
+
 def send_feedback(eval_req: EvaluationRequest):
     http_resp = requests.put(f"{server_url}/evaluation", data=eval_req.model_dump_json(), timeout=300)
     if http_resp.status_code == 200:
@@ -48,6 +63,38 @@ def show_asst_resp(chat_resp: Response):
     md = ["##### Reasoning", chat_resp.reasoning, "##### Response", chat_resp.resp]
     st.markdown("\n".join(md))
 
+def show_asst_resp_stream(chat_req: Request) -> Response:
+    stage = st.empty()
+    reasoning_area = st.empty()
+    response_area = st.empty()
+
+    reasoning = ""
+    response = ""
+    for event, data in stream_req(chat_req):
+        if event == "stage":
+            if data["stage"] == "reranked":
+                stage.caption("Referenced docs: " + ", ".join(os.path.basename(doc) for doc in data["docs"]))
+            elif data["stage"] == "rewritten":
+                stage.caption(f"Searching for: {data['query']}")
+            else:
+                stage.caption("Searching the docs ...")
+        elif event == "reasoning":
+            reasoning = reasoning + data
+            reasoning_area.markdown("\n".join(["##### Reasoning", reasoning]))
+        elif event == "response":
+            response = response + data
+            response_area.markdown("\n".join(["##### Response", response]))
+        elif event == "done":
+            chat_resp = Response.model_validate(data)
+            stage.empty()
+            reasoning_area.markdown("\n".join(["##### Reasoning", chat_resp.reasoning]))
+            response_area.markdown("\n".join(["##### Response", chat_resp.resp]))
+            return chat_resp, None
+        elif event == "error":
+            return None, data["detail"]
+
+    return None, "failed to response, the response stream is closed unexpectedly"
+
 # start the web page
 # TODO using st.sidebar to add configuration
 st.set_page_config(page_icon="💬", layout="wide", page_title="ACM Assistant")
@@ -111,20 +158,18 @@ if prompt := st.chat_input(placeholder="Message ACM Assistant"):
     with st.chat_message("user", avatar="👨‍💻"):
         st.markdown(prompt)
 
-    with st.spinner("Thinking ..."):
-        req = Request(query=prompt)
-        if st.session_state["response"] is not None:
-            req.issue_id = st.session_state["response"].issue_id
+    req = Request(query=prompt)
+    if st.session_state["response"] is not None:
+        req.issue_id = st.session_state["response"].issue_id
 
-        resp, err = send_req(chat_req=req)
+    with st.chat_message("assistant", avatar="🤖"):
+        resp, err = show_asst_resp_stream(chat_req=req)
         if err is not None:
             st.error(err)
             st.stop()
 
         st.session_state["response"] = resp
-        with st.chat_message("assistant", avatar="🤖"):
-            messages.append({"role": "assistant", "content": st.session_state["response"]})
-            show_asst_resp(st.session_state["response"])
+        messages.append({"role": "assistant", "content": st.session_state["response"]})
 
 if st.session_state["response"]:
     feedback = streamlit_feedback(
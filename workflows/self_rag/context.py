@@ -0,0 +1,76 @@
+# coding: utf-8
+
+"""
+The context assembly for RAG workflow
+"""
+
+import logging
+from pydantic import BaseModel
+from models.chat import Record
+from tools.common import count_tokens, truncate_tokens
+
+logger = logging.getLogger(__name__)
+
+class ContextBudget(BaseModel):
+    """
+    The token budget of the response context
+      - max_tokens: the maximum tokens of the notices, query, history summary, history records and documents.
+      - history_max_tokens: the maximum tokens of the history records, the unused part is left to the
+            documents.
+      - min_doc_tokens: a document is truncated to the remaining budget only if at least this many
+            tokens remain, otherwise it is dropped.
+    """
+
+    max_tokens: int = 8000
+    history_max_tokens: int = 2000
+    min_doc_tokens: int = 128
+
+class ResponseContext(BaseModel):
+    documents: list[str]
+    # the names of the packed documents, the dropped documents are not referenced
+    doc_names: list[str]
+    history_records: list[Record]
+    tokens: int
+
+def assemble_context(budget: ContextBudget, model: str, notices: str, query: str, history_summary: str,
+                     documents: list[str], doc_names: list[str], history_records: list[Record]) -> ResponseContext:
+    """
+    Pack the documents and the history records into the token budget, the documents are ordered by
+    the rerank score, so the highest-scoring documents are kept first, and the most recent history
+    records are kept first.
+    """
+    used = count_tokens(notices, model=model) + count_tokens(query, model=model) + \
+        count_tokens(history_summary, model=model)
+
+    # keep the most recent history records, a user query is kept with its response
+    history_budget = min(budget.history_max_tokens, max(budget.max_tokens - used, 0))
+    history_tokens = 0
+    kept_records = []
+    for i in range(len(history_records) - 1, -1, -2):
+        turn = history_records[max(i - 1, 0):i + 1]
+        tokens = sum(count_tokens(record.message, model=model) for record in turn)
+        if history_tokens + tokens > history_budget:
+            break
+        kept_records = turn + kept_records
+        history_tokens = history_tokens + tokens
+    used = used + history_tokens
+
+    kept_docs = []
+    kept_names = []
+    for doc, doc_name in zip(documents, doc_names):
+        remaining = budget.max_tokens - used
+        tokens = count_tokens(doc, model=model)
+        if tokens > remaining:
+            if remaining >= budget.min_doc_tokens:
+                kept_docs.append(truncate_tokens(doc, remaining, model=model))
+                kept_names.append(doc_name)
+                used = used + remaining
+            break
+        kept_docs.append(doc)
+        kept_names.append(doc_name)
+        used = used + tokens
+
+    if len(kept_docs) < len(documents) or len(kept_records) < len(history_records):
+        logger.info("context is limited to %d tokens (docs=%d/%d, history_records=%d/%d)", budget.max_tokens,
+                    len(kept_docs), len(documents), len(kept_records), len(history_records))
+    return ResponseContext(documents=kept_docs, doc_names=kept_names, history_records=kept_records, tokens=used)
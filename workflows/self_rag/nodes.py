@@ -4,34 +4,85 @@
 The nodes for RAG workflow
 """
 
+import contextvars
+import dspy
 import logging
-from signatures.response import respond
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.runnables import RunnableConfig
+from langgraph.types import StreamWriter
+from llama_index.core.schema import NodeWithScore
+from pydantic import BaseModel
+from prompts.templates import RESPONSE_NOTICES
+from signatures.response import respond, stream_respond
 from signatures.retriever import convert_question
 from services.index import RAGService
-from workflows.self_rag.state import copy_state
+from tools.metrics import incr, span
+from workflows.self_rag.context import ContextBudget, ResponseContext, assemble_context
+from workflows.self_rag.state import GraphState, copy_state
 
 logger = logging.getLogger(__name__)
 
-def retrieve_func(rag_svc: RAGService):
-    def retrieve(state):
+class RetrieveMetrics(BaseModel):
+    original_wins: int = 0
+    rewritten_wins: int = 0
+    no_wins: int = 0
+    rewrites_discarded: int = 0
+
+class RetrieveCounters:
+    """
+    The counters of the speculative retrieval, which path produces the nodes.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = RetrieveMetrics()
+
+    def incr(self, name: str):
+        with self._lock:
+            setattr(self._metrics, name, getattr(self._metrics, name) + 1)
+
+    def metrics(self) -> RetrieveMetrics:
+        with self._lock:
+            return self._metrics.model_copy()
+
+def retrieve_func(rag_svc: RAGService, speculative=False, counters: RetrieveCounters=None, rewrite_workers=4):
+    # a request rewrites at most one query at a time, so the rewrites are bounded by the in-flight requests
+    executor = ThreadPoolExecutor(max_workers=rewrite_workers, thread_name_prefix="rewrite") if speculative else None
+    if counters is None:
+        counters = RetrieveCounters()
+
+    def retrieve(state, writer: StreamWriter):
         current_state = copy_state(state)
+        writer(("stage", {"stage": "retrieving"}))
 
         sources = current_state["doc_sources"]
         retrieval_times = current_state["retrieval_times"]
         query = current_state["query"]
 
-        nodes = rag_svc.retrieve(query=query, sources=sources)
-        if len(nodes) == 0:
-            # TODO may need contexts (current_state["history_records"]) for new query
-            new_query = convert_question(contexts={}, query=query)
-            logger.info("no relevant nodes for query: %s, generate a new query: %s", query, new_query)
-            nodes = rag_svc.retrieve(query=new_query, sources=sources)
+        if speculative:
+            nodes, new_query = speculative_retrieve(rag_svc, executor, counters, query, sources)
+            if new_query is not None:
+                writer(("stage", {"stage": "rewritten", "query": new_query}))
+        else:
+            nodes = rag_svc.retrieve(query=query, sources=sources)
+            new_query = query
             if len(nodes) == 0:
-                logger.warning("no relevant nodes for query: %s", new_query)
-                current_state["terminated"] = True
-                current_state["response"] = "I have no idea for this issue."
-                current_state["reasoning"] = "No similar docs are found."
-                return current_state
+                # TODO may need contexts (current_state["history_records"]) for new query
+                incr("rewrite_fallbacks")
+                with span("rewrite"):
+                    new_query = convert_question(contexts={}, query=query)
+                logger.info("no relevant nodes for query: %s, generate a new query: %s", query, new_query)
+                writer(("stage", {"stage": "rewritten", "query": new_query}))
+                nodes = rag_svc.retrieve(query=new_query, sources=sources)
+
+        if len(nodes) == 0:
+            logger.warning("no relevant nodes for query: %s", new_query)
+            incr("terminations")
+            current_state["terminated"] = True
+            current_state["response"] = "I have no idea for this issue."
+            current_state["reasoning"] = "No similar docs are found."
+            return current_state
 
         relevant_docs = []
         relevant_doc_names = []
@@ -46,19 +97,84 @@ def retrieve_func(rag_svc: RAGService):
 
     return retrieve
 
-def answer_func():
-    def answer(state):
-        current_state = copy_state(state)
+def speculative_retrieve(rag_svc: RAGService, executor: ThreadPoolExecutor, counters: RetrieveCounters,
+                         query: str, sources: list[str]) -> tuple[list[NodeWithScore], str]:
+    """
+    Retrieve with the query while the query is rewritten concurrently, the rewritten query is retrieved
+    as soon as it is ready. The nodes of the query are used if there are any, otherwise the nodes of the
+    rewritten query are used, and the rewrite is discarded if it is not needed. Return the nodes and the
+    rewritten query if it is used.
+    """
+    # the dspy settings are per thread, so the LM of the caller is passed into the rewrite
+    lm = dspy.settings.lm
+    discarded = threading.Event()
 
-        documents = current_state["relevant_docs"]
-        query = current_state["query"]
-        history_records = current_state["history_records"]
+    def retrieve_rewritten() -> tuple[list[NodeWithScore], str]:
+        with dspy.context(lm=lm), span("rewrite"):
+            new_query = convert_question(contexts={}, query=query)
+        if discarded.is_set():
+            return [], new_query
+        logger.info("generate a new query: %s for query: %s", new_query, query)
+        return rag_svc.retrieve(query=new_query, sources=sources), new_query
 
-        # TODO (optimize) check the token size of the documents and history to limit the context
-        result = respond(documents=documents, query=query, history_records=history_records)
+    # the context is copied, so the spans of the rewrite share the request id
+    rewritten = executor.submit(contextvars.copy_context().run, retrieve_rewritten)
+    nodes = rag_svc.retrieve(query=query, sources=sources)
+    if len(nodes) > 0:
+        discarded.set()
+        if not rewritten.cancel():
+            counters.incr("rewrites_discarded")
+        counters.incr("original_wins")
+        return nodes, None
 
+    logger.info("no relevant nodes for query: %s, wait for the rewritten query", query)
+    incr("rewrite_fallbacks")
+    nodes, new_query = rewritten.result()
+    counters.incr("rewritten_wins" if len(nodes) > 0 else "no_wins")
+    return nodes, new_query
+
+def answer_func(budget: ContextBudget):
+    def answer(state, config: RunnableConfig, writer: StreamWriter):
+        current_state = copy_state(state)
+
+        context = build_context(current_state, budget)
+        # only the docs that fit into the context are referenced
+        current_state["relevant_doc_names"] = context.doc_names
+        writer(("stage", {"stage": "reranked", "docs": context.doc_names}))
+        with span("answer"):
+            if config.get("configurable", {}).get("stream", False):
+                result = stream_answer(context, current_state, writer)
+            else:
+                result = respond(documents=context.documents, query=current_state["query"],
+                                 history_records=context.history_records,
+                                 history_summary=current_state["history_summary"])
+
+        current_state["context_tokens"] = context.tokens
         current_state["response"] = result.response
         current_state["reasoning"] = result.reasoning
         return current_state
 
     return answer
+
+def stream_answer(context: ResponseContext, state: GraphState, writer: StreamWriter) -> dspy.Prediction:
+    # write ("reasoning", delta) and ("response", delta) as the LM produces the tokens
+    for field, value in stream_respond(documents=context.documents, query=state["query"],
+                                       history_records=context.history_records,
+                                       history_summary=state["history_summary"]):
+        if field == "prediction":
+            return value
+        writer((field, value))
+    return None
+
+def build_context(state: GraphState, budget: ContextBudget) -> ResponseContext:
+    # the tokenizer is matched to the LM of the current request
+    return assemble_context(
+        budget=budget,
+        model=dspy.settings.lm.model,
+        notices=RESPONSE_NOTICES,
+        query=state["query"],
+        history_summary=state["history_summary"],
+        documents=state["relevant_docs"],
+        doc_names=state["relevant_doc_names"],
+        history_records=state["history_records"],
+    )
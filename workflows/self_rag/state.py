@@ -18,6 +18,7 @@ class GraphState(TypedDict):
     relevant_doc_names: list[str]
 
     # history records (input)
+    history_summary: str
     history_records: list[Record]
 
     # from user (input)
@@ -27,6 +28,9 @@ class GraphState(TypedDict):
     response: str
     reasoning: str
 
+    # the tokens of the response context
+    context_tokens: int
+
     # flags
     retrieval_times: int
     terminated: bool
@@ -36,23 +40,27 @@ def copy_state(state: GraphState) -> GraphState:
         doc_sources=state["doc_sources"],
         relevant_docs=state["relevant_docs"],
         relevant_doc_names=state["relevant_doc_names"],
+        history_summary=state["history_summary"],
         history_records=state["history_records"],
         query=state["query"],
         response=state["response"],
         reasoning=state["reasoning"],
+        context_tokens=state["context_tokens"],
         retrieval_times=state["retrieval_times"],
         terminated=state["terminated"],
     )
 
-def new_state(doc_sources: list[str], query: str, history_records: list[Record]) -> GraphState:
+def new_state(doc_sources: list[str], query: str, history_records: list[Record], history_summary="") -> GraphState:
     return GraphState(
         doc_sources=doc_sources,
         relevant_docs=[],
         relevant_doc_names=[],
+        history_summary=history_summary,
         history_records=history_records,
         query=query,
         response="",
         reasoning="",
+        context_tokens=0,
         retrieval_times=0,
         terminated=False,
     )
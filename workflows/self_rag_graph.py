@@ -6,15 +6,18 @@ The self RAG workflow
 
 from langgraph.graph import END, StateGraph, START
 from services.index import RAGService
+from workflows.self_rag.context import ContextBudget
 from workflows.self_rag.state import GraphState
-from workflows.self_rag.nodes import retrieve_func, answer_func
+from workflows.self_rag.nodes import RetrieveCounters, retrieve_func, answer_func
 from workflows.self_rag.edges import dispatch
 
-def build_self_rag_graph(rag_svc: RAGService):
+def build_self_rag_graph(rag_svc: RAGService, budget: ContextBudget,
+                         speculative=False, counters: RetrieveCounters=None, rewrite_workers=4):
     workflow = StateGraph(GraphState)
 
-    workflow.add_node("retrieve", retrieve_func(rag_svc=rag_svc))
-    workflow.add_node("answer", answer_func())
+    workflow.add_node("retrieve", retrieve_func(rag_svc=rag_svc, speculative=speculative, counters=counters,
+                                                rewrite_workers=rewrite_workers))
+    workflow.add_node("answer", answer_func(budget=budget))
 
     # Build graph
     workflow.add_edge(START, "retrieve")